@@ -1,49 +1,56 @@
 import os
 import streamlit as st
-import requests
-import re
 import random
-import json
-import hashlib  # 画像ハッシュ用
+import sqlite3
 import time    # 遅延用
-from io import BytesIO
 from PIL import Image
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-
-# ▼ 画像解析用（ViTモデル）
-import torch
-from transformers import AutoFeatureExtractor, ViTForImageClassification
-# ▲
+import queue
 
 from streamlit_chat import message  # streamlit-chat のメッセージ表示用関数
 
+import http_client  # 共有HTTPクライアント（コネクションプール・タイムアウト・再試行）
+import persona_orchestrator  # ペルソナ並列実行（共有イベントループ）
+import image_analysis  # ViT 推論（バッチ化TTA・遅延読み込み。torch / transformers は初回利用時に import）
+import image_cache  # 画像解析結果のディスクキャッシュ（SQLite）
+import image_ingest  # 画像の取り込み（縮小デコード・EXIF の向き補正・サイズ上限）
+import image_dedup  # 近似重複画像の索引（dHash ＋ BK 木）
+import search_cache  # Tavily 検索結果の TTL + LRU キャッシュ
+import response_cache  # Gemini 応答キャッシュ ＋ 同一リクエストの集約
+import chat_render  # 吹き出し HTML と履歴の表示範囲（ウィンドウ・ページ）
+import conversation_context  # トークン予算つきの会話コンテキスト（差分要約）
+import upstream_scheduler  # 上流 API の流量制限・優先度・サーキットブレーカー
+import metrics  # ステージごとの所要時間・カウンタ（JSONL / Prometheus 出力）
+import persona_latency  # ペルソナごとの所要時間とヘッジ・ターンの期限
+import chat_engine  # 会話エンジン（API 呼び出し・ペルソナ・検索・画像解析。Streamlit 非依存）
+import conversation_store  # 会話ログ（直近だけメモリに持ち、全件を SQLite に保存・再開）
+
 # =============================================================================
 # 1. 基本設定・スタイル設定
 # =============================================================================
 st.set_page_config(page_title="ぼくのともだち", layout="wide")
 st.title("ぼくのともだち V3.0 + 画像解析＆検索")
 
-# config.toml からテーマ設定を読み込み
-try:
+# config.toml からテーマ設定を読み込み（プロセス内で1回だけ）
+@st.cache_resource
+def load_theme_config() -> dict:
     try:
-        import tomllib  # Python 3.11以降の場合
-    except ImportError:
-        import toml as tomllib
-    with open("config.toml", "rb") as f:
-        config_data = tomllib.load(f)
-    theme_config = config_data.get("theme", {})
-    primaryColor = theme_config.get("primaryColor", "#729075")
-    backgroundColor = theme_config.get("backgroundColor", "#f1ece3")
-    secondaryBackgroundColor = theme_config.get("secondaryBackgroundColor", "#fff8ef")
-    textColor = theme_config.get("textColor", "#5e796a")
-    font = theme_config.get("font", "monospace")
-except Exception:
-    primaryColor = "#729075"
-    backgroundColor = "#f1ece3"
-    secondaryBackgroundColor = "#fff8ef"
-    textColor = "#5e796a"
-    font = "monospace"
+        try:
+            import tomllib  # Python 3.11以降の場合
+        except ImportError:
+            import toml as tomllib
+        with open("config.toml", "rb") as f:
+            config_data = tomllib.load(f)
+        return config_data.get("theme", {})
+    except Exception:
+        return {}
+
+theme_config = load_theme_config()
+primaryColor = theme_config.get("primaryColor", "#729075")
+backgroundColor = theme_config.get("backgroundColor", "#f1ece3")
+secondaryBackgroundColor = theme_config.get("secondaryBackgroundColor", "#fff8ef")
+textColor = theme_config.get("textColor", "#5e796a")
+font = theme_config.get("font", "monospace")
 
 st.markdown(
     f"""
@@ -83,6 +90,24 @@ st.markdown(
     unsafe_allow_html=True
 )
 
+# 会話ログは URL の ?sid= ごとに保存する（再読み込みやプロセスの再起動後も同じ会話を続ける）
+def open_conversation() -> conversation_store.ConversationStore:
+    if hasattr(st, "query_params"):
+        requested = st.query_params.get("sid")
+        store = conversation_store.open_session(requested)
+        if requested != store.session_id:
+            st.query_params["sid"] = store.session_id
+    else:
+        requested = (st.experimental_get_query_params().get("sid") or [""])[0]
+        store = conversation_store.open_session(requested)
+        if requested != store.session_id:
+            st.experimental_set_query_params(sid=store.session_id)
+    return store
+
+if "conversation" not in st.session_state:
+    st.session_state.conversation = open_conversation()
+conversation = st.session_state.conversation
+
 # =============================================================================
 # 2. ユーザー入力とサイドバー設定
 # =============================================================================
@@ -106,15 +131,28 @@ if st.sidebar.button("クイズを開始する", key="quiz_start_button"):
     st.session_state.quiz_active = True
     st.session_state.quiz_question = quiz["question"]
     st.session_state.quiz_answer = quiz["answer"]
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = []
-    st.session_state["messages"].append({"role": "クイズ", "content": "クイズ: " + quiz["question"]})
+    conversation.append("クイズ", "クイズ: " + quiz["question"])
 
 st.sidebar.header("画像解析")
 # アップロードウィジェットのキーは "file_uploader_key"（後でクリア）
 uploaded_image = st.sidebar.file_uploader("画像をアップロードしてください", type=["png", "jpg", "jpeg"], key="file_uploader_key")
+st.sidebar.multiselect(
+    "TTA（テスト時拡張、空なら無効）",
+    options=list(image_analysis.TTA_AUGMENTATIONS),
+    default=list(image_analysis.TTA_CONFIG),
+    key="vit_tta",
+)
+st.sidebar.caption(
+    f"画像モデル: {image_analysis.MODEL_TIER}（{image_analysis.MODEL_TIERS.get(image_analysis.MODEL_TIER, ('?',))[0]}）"
+    f" / {'読み込み済み' if image_analysis.is_model_loaded() else '未読み込み（初回解析時に読み込み）'}"
+)
 
 use_internet = st.sidebar.checkbox("インターネット検索を使用する", value=True, key="internet_search_checkbox_1")
+
+st.sidebar.header("表示設定")
+st.sidebar.checkbox("回答をストリーミング表示する", value=True, key="streaming_mode")
+st.sidebar.checkbox("全員の回答を1回のリクエストでまとめて生成する", value=False, key="single_call_mode")
+st.sidebar.slider("タイピング演出（文字/秒、0で無効）", min_value=0, max_value=200, value=0, step=10, key="typing_cps")
 st.sidebar.info("※スマホの場合は、画面左上のハンバーガーメニューからサイドバーにアクセスできます。")
 
 # =============================================================================
@@ -128,32 +166,28 @@ MINORU_NAME = "みのる"
 NEW_CHAR_NAME = "新キャラクター"
 NAMES = [YUKARI_NAME, SHINYA_NAME, MINORU_NAME]
 
+def save_conversation_meta():
+    # 再開時に同じ新キャラクター・同じ要約で続けられるよう、会話ログと一緒に保存する
+    conversation.save_meta({
+        "new_char": list(st.session_state.new_char),
+        "context_state": st.session_state.context_state,
+    })
+
+if "context_state" not in st.session_state:
+    st.session_state.context_state = conversation.meta.get("context_state") or conversation_context.new_state()
 if "new_char" not in st.session_state:
-    def generate_new_character():
-        if custom_new_char_name.strip() and custom_new_char_personality.strip():
-            return custom_new_char_name.strip(), custom_new_char_personality.strip()
-        candidates = [
-            ("たけし", "冷静沈着で皮肉屋、どこか孤高な存在"),
-            ("さとる", "率直かつ辛辣で、常に現実を鋭く指摘する"),
-            ("りさ", "自由奔放で斬新なアイデアを持つ、ユニークな感性の持ち主"),
-            ("けんじ", "クールで合理的、論理に基づいた意見を率直に述べる"),
-            ("なおみ", "独創的で個性的、常識にとらわれず新たな視点を提供する")
-        ]
-        return random.choice(candidates)
-    st.session_state.new_char = generate_new_character()
+    if conversation.meta.get("new_char"):
+        st.session_state.new_char = tuple(conversation.meta["new_char"])
+    else:
+        # 名前・性格が未入力なら候補からランダムに選ぶ
+        st.session_state.new_char = chat_engine.pick_new_character(custom_new_char_name, custom_new_char_personality)
+        save_conversation_meta()
 new_name, new_personality = st.session_state.new_char
 
 API_KEY = st.secrets["general"]["api_key"]
-MODEL_NAME = "gemini-2.0-flash-001"
 
-if "messages" not in st.session_state:
-    st.session_state["messages"] = []
-if "analyzed_images" not in st.session_state:
-    st.session_state["analyzed_images"] = {}
 if "last_uploaded_hash" not in st.session_state:
     st.session_state.last_uploaded_hash = None
-if "search_cache" not in st.session_state:
-    st.session_state.search_cache = {}
 if "gemini_status" not in st.session_state:
     st.session_state.gemini_status = ""
 if "tavily_status" not in st.session_state:
@@ -162,21 +196,31 @@ if "chat_index" not in st.session_state:
     st.session_state.chat_index = 0
 if "image_conversation_done" not in st.session_state:
     st.session_state.image_conversation_done = False
+if "late_replies" not in st.session_state:
+    st.session_state.late_replies = []  # 期限までに届かなかったペルソナの [(名前, Future)]
 
 # =============================================================================
 # 4. アイコン画像の読み込み
 # =============================================================================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 avatar_dir = os.path.join(BASE_DIR, "avatars")
-try:
-    img_user = Image.open(os.path.join(avatar_dir, "user.png"))
-    img_yukari = Image.open(os.path.join(avatar_dir, "yukari.png"))
-    img_shinya = Image.open(os.path.join(avatar_dir, "shinya.png"))
-    img_minoru = Image.open(os.path.join(avatar_dir, "minoru.png"))
-    img_newchar = Image.open(os.path.join(avatar_dir, "new_character.png"))
-except Exception as e:
-    st.error(f"画像読み込みエラー: {e}")
-    img_user, img_yukari, img_shinya, img_minoru, img_newchar = "👤", "🌸", "🌊", "🍀", "⭐"
+
+@st.cache_resource
+def load_avatars():
+    # アイコン画像はプロセス内で1回だけ読み込む（再実行ごとに開き直さない）
+    try:
+        images = []
+        for filename in ("user.png", "yukari.png", "shinya.png", "minoru.png", "new_character.png"):
+            with Image.open(os.path.join(avatar_dir, filename)) as img:
+                img.load()
+                images.append(img.copy())
+        return tuple(images), None
+    except Exception as e:
+        return ("👤", "🌸", "🌊", "🍀", "⭐"), str(e)
+
+(img_user, img_yukari, img_shinya, img_minoru, img_newchar), avatar_error = load_avatars()
+if avatar_error:
+    st.error(f"画像読み込みエラー: {avatar_error}")
 
 avatar_img_dict = {
     USER_NAME: img_user,
@@ -192,339 +236,309 @@ avatar_img_dict = {
 # =============================================================================
 # 5. 各種API呼び出し、画像解析、検索処理
 # =============================================================================
-def remove_json_artifacts(text: str, pattern: str = r"'parts': \[\{'text':.*?\}\], 'role': 'model'") -> str:
-    if not isinstance(text, str):
-        text = str(text) if text else ""
-    cleaned = re.sub(pattern, "", text, flags=re.DOTALL)
-    return cleaned.strip()
-
-def call_gemini_api(prompt: str) -> str:
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{MODEL_NAME}:generateContent?key={API_KEY}"
-    payload = {"contents": [{"parts": [{"text": prompt}]}]}
-    headers = {"Content-Type": "application/json"}
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            st.session_state.gemini_status = "Gemini API: OK"
-        else:
-            st.session_state.gemini_status = f"Gemini API Error {response.status_code}: {response.text}"
-    except Exception as e:
-        st.session_state.gemini_status = f"Gemini API Exception: {str(e)}"
-        return f"エラー: リクエスト送信時に例外が発生しました -> {str(e)}"
-    try:
-        rjson = response.json()
-        candidates = rjson.get("candidates", [])
-        if not candidates:
-            st.session_state.gemini_status = "Gemini API Error: candidatesが空"
-            return "回答が見つかりませんでした。(candidatesが空)"
-        candidate0 = candidates[0]
-        content_val = candidate0.get("content", "")
-        if isinstance(content_val, dict):
-            parts = content_val.get("parts", [])
-            content_str = " ".join([p.get("text", "") for p in parts])
-        else:
-            content_str = str(content_val)
-        content_str = content_str.strip()
-        if not content_str:
-            st.session_state.gemini_status = "Gemini API Error: contentが空"
-            return "回答が見つかりませんでした。(contentが空)"
-        st.session_state.gemini_status = "Gemini API: OK"
-        return remove_json_artifacts(content_str)
-    except Exception as e:
-        st.session_state.gemini_status = f"Gemini API 応答解析エラー: {str(e)}"
-        return f"エラー: レスポンス解析に失敗しました -> {str(e)}"
-
-@st.cache_resource
-def load_image_classification_model():
-    model_name = "google/vit-large-patch16-224"  # ViT-Large
-    extractor = AutoFeatureExtractor.from_pretrained(model_name)
-    model = ViTForImageClassification.from_pretrained(model_name)
-    model.eval()
-    return extractor, model
-
-extractor, vit_model = load_image_classification_model()
-
-def analyze_image_with_vit(pil_image: Image.Image) -> str:
-    if pil_image.mode != "RGB":
-        pil_image = pil_image.convert("RGB")
-    from torchvision import transforms as T
-    augmentation_transforms = [
-         T.Compose([]),
-         T.Compose([T.RandomHorizontalFlip(p=1.0)]),
-         T.Compose([T.RandomRotation(degrees=15)]),
-    ]
-    all_logits = []
-    for aug in augmentation_transforms:
-         augmented_img = aug(pil_image)
-         inputs = extractor(augmented_img, return_tensors="pt")
-         with torch.no_grad():
-             outputs = vit_model(**inputs)
-         all_logits.append(outputs.logits)
-    avg_logits = sum(all_logits) / len(all_logits)
-    probs = torch.nn.functional.softmax(avg_logits, dim=1)[0]
-    topk = avg_logits.topk(3, dim=1)
-    top_indices = topk.indices[0].tolist()
-    labels = vit_model.config.id2label
-    result_str = []
-    for idx in top_indices:
-         label_name = labels[idx]
-         confidence = probs[idx].item()
-         result_str.append(f"{label_name} ({confidence*100:.1f}%)")
-    return ", ".join(result_str)
-
-from concurrent.futures import ThreadPoolExecutor
-
-@st.cache_data(show_spinner=False)
-def cached_get_search_info(query: str) -> str:
-    url = "https://api.tavily.com/search"
-    api_key = st.secrets["tavily"]["api_key"]
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    payload = {
-         "query": query,
-         "topic": "general",
-         "search_depth": "basic",
-         "max_results": 1,
-         "time_range": None,
-         "days": 3,
-         "include_answer": True,
-         "include_raw_content": False,
-         "include_images": False,
-         "include_image_descriptions": False,
-         "include_domains": [],
-         "exclude_domains": []
-    }
-    try:
-         response = requests.post(url, headers=headers, json=payload)
-         if response.status_code == 200:
-             st.session_state.tavily_status = "tavily API: OK"
-         else:
-             st.session_state.tavily_status = f"tavily API Error {response.status_code}: {response.text}"
-         data = response.json()
-         result = data.get("answer", "")
-         return result
-    except Exception as e:
-         st.session_state.tavily_status = f"tavily API Exception: {str(e)}"
-         return ""
-
-executor = ThreadPoolExecutor(max_workers=1)
-
-def async_get_search_info(query: str) -> str:
-    with st.spinner("最新情報を検索中…"):
-        future = executor.submit(cached_get_search_info, query)
-        return future.result()
-
-def discuss_image_analysis(analysis_text: str, ai_age: int) -> str:
-    prompt = (
-        f"以下の画像解析結果に基づいて、この写真を実際に見たかのように、感想や詳細な説明をしてください。\n"
-        f"解析情報（内部利用のみ）: {analysis_text}\n\n"
-        f"あなたの回答のみを出力してください。"
+# 本体は chat_engine（Streamlit 非依存）。ここでは結果を session_state に反映する
+engine = chat_engine.ChatEngine(API_KEY, st.secrets.get("tavily", {}).get("api_key", ""))
+
+def current_user_name() -> str:
+    return st.session_state.get("user_name", chat_engine.DEFAULT_USER_NAME)
+
+if image_analysis.WARMUP:
+    image_analysis.start_warmup()
+
+def analyze_image_cached(image_bytes: bytes, image_hash: str) -> str:
+    # ディスクキャッシュ（全セッション・プロセス共通）→ 近似重複 → ViT 推論 の順に探す
+    augmentations = image_analysis.canonical_tta(st.session_state.get("vit_tta") or ())
+    # モデル階層は環境変数 VIT_MODEL_TIER で選択（初回の画像解析時にプロセス内で1回だけ読み込む）
+    spinner_text = "画像を解析中…" if image_analysis.is_model_loaded() else "画像解析モデルを読み込み中…"
+    with st.spinner(spinner_text):
+        return engine.analyze_image(image_bytes, augmentations, image_hash)
+
+def start_search_info(query: str):
+    # 検索要否をローカルで判定し、必要なら共有ループ上で検索を開始して Future を返す（不要なら None）
+    future, skipped = engine.start_search(query)
+    if future is None:
+        st.session_state.tavily_status = skipped
+    return future
+
+def await_search_info(future) -> str:
+    if future is None:
+        return ""
+    with st.spinner("最新情報を検索中…"), metrics.timer("search_wait"):
+        try:
+            result = future.result()
+        except Exception as e:
+            st.session_state.tavily_status = f"tavily API Exception: {str(e)}"
+            return ""
+    if result.cache == "hit":
+        st.session_state.tavily_status = "tavily API: OK（キャッシュヒット）"
+    elif result.cache == "negative-hit":
+        st.session_state.tavily_status = "tavily API: 直近で失敗したクエリのため検索を省略（キャッシュ）"
+    else:
+        st.session_state.tavily_status = result.detail + "（キャッシュミス）"
+    return result.answer
+
+def build_agents(persona_params: dict) -> list:
+    return chat_engine.build_agents(persona_params, (new_name, new_personality))
+
+def iter_discussion(question: str, persona_params: dict, ai_age: int, search_info: str = "", context: str = "",
+                    priority: int = upstream_scheduler.PRIORITY_INTERACTIVE):
+    # 共有イベントループで全ペルソナを同時に呼び出し、完了した順に (名前, 回答, 遅延か) を返す
+    # 期限を過ぎたペルソナの回答は届き次第、次の再実行で会話に追加する
+    late = {}
+    for name, reply in engine.iter_discussion(
+        build_agents(persona_params), question, ai_age, search_info, context, current_user_name(), priority, late=late
+    ):
+        st.session_state.gemini_status = reply.status
+        if name in late:
+            st.session_state.late_replies.append((name, late[name]))
+        yield name, reply.text, name in late
+
+def generate_discussion_single_call(question: str, persona_params: dict, ai_age: int, search_info: str = "", context: str = "",
+                                    priority: int = upstream_scheduler.PRIORITY_INTERACTIVE):
+    responses, reply = engine.discussion_single_call(
+        build_agents(persona_params), question, ai_age, search_info, context, current_user_name(), priority
     )
-    return call_gemini_api(prompt)
-
-def adjust_parameters(input_text, ai_age):
-    return {
-       "ゆかり": {"style": "温かく優しい", "detail": "実際に写真を見たかのように、感想を述べます"},
-       "しんや": {"style": "冷静沈着", "detail": "写真から感じた現実的な印象を分析します"},
-       "みのる": {"style": "ユーモアたっぷり", "detail": "写真の面白さや細かい所を冗談交じりにコメントします"}
-    }
-
-class ChatAgent:
-    def __init__(self, name, style, detail):
-        self.name = name
-        self.style = style
-        self.detail = detail
-
-    def generate_response(self, question: str, ai_age: int, search_info: str = "") -> str:
-        current_user = st.session_state.get("user_name", "ユーザー")
-        prompt = f"【{current_user}さんの質問】\n{question}\n\n"
-        if search_info:
-            prompt += f"最新情報によると、{search_info}という報告があります。\n"
-        prompt += f"このAIは{ai_age}歳として振る舞います。\n"
-        prompt += f"{self.name}は【{self.style}な視点】で、{self.detail}。\n"
-        prompt += "あなたの回答のみを出力してください。"
-        response = call_gemini_api(prompt)
-        return response
-
-def generate_discussion_parallel(question: str, persona_params: dict, ai_age: int, search_info: str = "") -> str:
-    agents = []
-    for name, params in persona_params.items():
-        agents.append(ChatAgent(name, params["style"], params["detail"]))
-    new_agent = ChatAgent(new_name, new_personality, "")
-    agents.append(new_agent)
-    responses = {}
-    with ThreadPoolExecutor(max_workers=len(agents)) as executor:
-        future_to_agent = {executor.submit(agent.generate_response, question, ai_age, search_info): agent for agent in agents}
-        for future in future_to_agent:
-            agent = future_to_agent[future]
-            responses[agent.name] = future.result()
-    conversation = "\n".join([f"{agent.name}: {responses[agent.name]}" for agent in agents])
-    return conversation
-
-def continue_discussion_parallel(additional_input: str, history: str, ai_age: int, search_info: str = "") -> str:
-    persona_params = adjust_parameters(additional_input, ai_age)
-    agents = []
-    for name, params in persona_params.items():
-        agents.append(ChatAgent(name, params["style"], params["detail"]))
-    new_agent = ChatAgent(new_name, new_personality, "")
-    agents.append(new_agent)
-    responses = {}
-    with ThreadPoolExecutor(max_workers=len(agents)) as executor:
-        future_to_agent = {executor.submit(agent.generate_response, additional_input, ai_age, search_info): agent for agent in agents}
-        for future in future_to_agent:
-            agent = future_to_agent[future]
-            responses[agent.name] = future.result()
-    conversation = "\n".join([f"{agent.name}: {responses[agent.name]}" for agent in agents])
-    return conversation
+    st.session_state.gemini_status = reply.status
+    return responses
 
 # =============================================================================
-# 7. 既存のチャットメッセージの表示
+# 6. ストリーミング表示（各ペルソナの吹き出しに届いた断片から順に書き込む）
 # =============================================================================
-for msg in st.session_state["messages"]:
-    role = msg["role"]
-    content = msg["content"]
-    display_name = user_name if role == "user" else role
+TYPING_DELAY_MAX = 0.5  # 1断片あたりのタイピング演出の上限（秒）
+
+def render_message(role: str, content: str) -> None:
+    # 全メッセージ共通の吹き出し表示
     if role == "user":
         with st.chat_message("user", avatar=avatar_img_dict.get(USER_NAME)):
-            st.markdown(
-                f'<div style="text-align: right;">'
-                f'<div class="chat-bubble">'
-                f'<div class="chat-header">{display_name}</div>{content}'
-                f'</div></div>',
-                unsafe_allow_html=True,
-            )
+            st.markdown(chat_render.bubble_html(user_name, content, "right"), unsafe_allow_html=True)
     else:
         with st.chat_message(role, avatar=avatar_img_dict.get(role, "🤖")):
-            st.markdown(
-                f'<div style="text-align: left;">'
-                f'<div class="chat-bubble">'
-                f'<div class="chat-header">{display_name}</div>{content}'
-                f'</div></div>',
+            st.markdown(chat_render.bubble_html(role, content), unsafe_allow_html=True)
+
+def typing_delay(text: str) -> float:
+    # タイピング演出（文字/秒、0で無効）。生成はワーカースレッドで続くため通信は待たせない
+    cps = st.session_state.get("typing_cps", 0)
+    if not cps:
+        return 0.0
+    return min(len(text) / cps, TYPING_DELAY_MAX)
+
+def stream_discussion(question: str, persona_params: dict, ai_age: int, search_info: str = "", context: str = "",
+                      priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> list:
+    agents = build_agents(persona_params)
+    # プロンプトはスクリプトスレッドで組み立てておく（ワーカーから session_state を触らない）
+    current_user = current_user_name()
+    prompts = {agent.name: agent.build_prompt(question, ai_age, search_info, current_user, context) for agent in agents}
+
+    placeholders = {}
+    for agent in agents:
+        with st.chat_message(agent.name, avatar=avatar_img_dict.get(agent.name, "🤖")):
+            placeholders[agent.name] = st.empty()
+            placeholders[agent.name].markdown(chat_render.bubble_html(agent.name, "…"), unsafe_allow_html=True)
+
+    chunk_queue = queue.Queue()
+
+    def produce(agent):
+        # 戻り値は全文の応答（期限後に完了した場合は late_replies から会話に追加する）
+        streamed = ""
+        try:
+            for chunk in engine.stream_persona(agent.name, prompts[agent.name], priority):
+                streamed += chunk
+                chunk_queue.put((agent.name, "chunk", chunk))
+        except Exception as e:
+            chunk_queue.put((agent.name, "error", e))
+            return chat_engine.Reply("", False, f"Gemini API Exception: {str(e)}")
+        finally:
+            chunk_queue.put((agent.name, "done", None))
+        content = chat_engine.remove_json_artifacts(streamed)
+        return chat_engine.Reply(content, bool(content), "Gemini API: OK")
+
+    texts = {agent.name: "" for agent in agents}
+    errors = {}
+    futures = {agent.name: persona_orchestrator.submit(produce, agent) for agent in agents}
+    pending = set(futures)
+    deadline_at = time.perf_counter() + persona_latency.TURN_DEADLINE
+    while pending:
+        try:
+            name, kind, value = chunk_queue.get(timeout=max(0.0, deadline_at - time.perf_counter()))
+        except queue.Empty:
+            break  # 期限切れ。残りのペルソナは遅延として扱う
+        if kind == "done":
+            pending.discard(name)
+        elif kind == "error":
+            errors[name] = value
+        else:
+            texts[name] += value
+            placeholders[name].markdown(chat_render.bubble_html(name, texts[name]), unsafe_allow_html=True)
+            delay = typing_delay(value)
+            if delay:
+                time.sleep(delay)
+
+    results = []
+    for agent in agents:
+        if agent.name in pending:
+            metrics.incr("persona_late", persona=chat_engine.persona_label(agent.name))
+            st.session_state.gemini_status = f"Gemini API: {persona_latency.TURN_DEADLINE:.0f} 秒以内に回答がありませんでした（{agent.name}）"
+            st.session_state.late_replies.append((agent.name, futures[agent.name]))
+            placeholders[agent.name].markdown(
+                chat_render.bubble_html(agent.name, texts[agent.name] + "\n" + chat_engine.PERSONA_LATE_MESSAGE),
                 unsafe_allow_html=True,
             )
+            continue
+        content = chat_engine.remove_json_artifacts(texts[agent.name])
+        if isinstance(errors.get(agent.name), upstream_scheduler.UpstreamUnavailable):
+            st.session_state.gemini_status = f"Gemini API: 縮退運転中（{str(errors[agent.name])}）"
+            content = content or chat_engine.GEMINI_BUSY_MESSAGE
+        elif agent.name in errors:
+            st.session_state.gemini_status = f"Gemini API Exception: {str(errors[agent.name])}"
+            if not content:
+                content = f"エラー: ストリーミング中に例外が発生しました -> {str(errors[agent.name])}"
+        elif not content:
+            st.session_state.gemini_status = "Gemini API Error: contentが空"
+            content = "回答が見つかりませんでした。(contentが空)"
+        else:
+            st.session_state.gemini_status = "Gemini API: OK"
+        placeholders[agent.name].markdown(chat_render.bubble_html(agent.name, content), unsafe_allow_html=True)
+        results.append((agent.name, content))
+    return results
+
+def build_conversation_context() -> str:
+    # 直前のユーザー発言より前の会話が対象。トークン予算内の直近の会話＋それより前の要約
+    # （要約は session_state と会話ログに保持し、差分だけ畳み込む。要約済みの発言は DB から読まない）
+    # 要約はターンを待たせないよう共有ループで行い、終わっていれば次のターンで反映する
+    state = st.session_state.get("context_state") or conversation_context.new_state()
+    pending = st.session_state.get("summary_job")
+    if pending is not None and pending[0].done():
+        future, request = st.session_state.pop("summary_job")
+        try:
+            summary = future.result()
+        except Exception:
+            summary = None  # 失敗したら要約待ちの発言を次の依頼に含めてやり直す
+        state = conversation_context.apply_summary(state, request, summary)
+    current_user = current_user_name()
+    end = len(conversation) - 1
+    start = min(state["summarized_upto"], end)
+    history = [(current_user if msg.role == "user" else msg.role, msg.content) for msg in conversation[start:end]]
+    context, st.session_state.context_state, request = conversation_context.build_context(history, state, offset=start)
+    if request is not None and "summary_job" not in st.session_state:
+        future = persona_orchestrator.submit(engine.summarize, request["summary"], request["lines"], request["max_chars"])
+        st.session_state.summary_job = (future, request)
+    save_conversation_meta()
+    return context
+
+def render_discussion(question: str, persona_params: dict, ai_age: int, search_info: str = "", context: str = "",
+                      priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> list:
+    # 1回のリクエストで全員分を生成するモード（解析に失敗したらペルソナごとの呼び出しに戻る）
+    if st.session_state.get("single_call_mode", False):
+        with st.spinner("みんなが考え中…"):
+            responses = generate_discussion_single_call(question, persona_params, ai_age, search_info, context, priority)
+        if responses is not None:
+            results = []
+            for role, content in responses.items():
+                render_message(role, content)
+                results.append((role, content))
+                time.sleep(typing_delay(content))
+            return results
+        st.session_state.gemini_status += "（一括生成の解析に失敗したため個別に生成）"
+    # ストリーミング表示、または完了したペルソナから順に吹き出しを表示する
+    if st.session_state.get("streaming_mode", True):
+        return stream_discussion(question, persona_params, ai_age, search_info, context, priority)
+    results = []
+    for role, content, late in iter_discussion(question, persona_params, ai_age, search_info, context, priority):
+        render_message(role, content)
+        if not late:
+            results.append((role, content))
+            time.sleep(typing_delay(content))
+    return results
+
+# =============================================================================
+# 7. 既存のチャットメッセージの表示（最新のウィンドウのみ、古いものは必要に応じて読み込む）
+# =============================================================================
+if "chat_window" not in st.session_state:
+    st.session_state.chat_window = chat_render.HISTORY_WINDOW
+
+def show_older_messages():
+    st.session_state.chat_window += chat_render.HISTORY_WINDOW
+
+# 期限後に届いたペルソナの回答を会話に追加する（まだ届いていないものは次の再実行で確認する）
+still_late = []
+for late_name, late_future in st.session_state.late_replies:
+    if not late_future.done():
+        still_late.append((late_name, late_future))
+        continue
+    late_reply = late_future.result()
+    if late_reply.ok:
+        conversation.append(late_name, late_reply.text)
+    else:
+        st.session_state.gemini_status = late_reply.status
+st.session_state.late_replies = still_late
+if still_late:
+    st.caption(f"回答待ち: {'、'.join(name for name, _ in still_late)}（届き次第、次の表示で追加します）")
+
+hidden_count, visible_messages = chat_render.window(conversation, st.session_state.chat_window)
+if hidden_count:
+    st.button(f"以前のメッセージを表示（残り {hidden_count} 件）", key="load_older_messages", on_click=show_older_messages)
+with metrics.timer("render_recent"):
+    for msg in visible_messages:
+        render_message(msg.role, msg.content)
 
 # =============================================================================
 # 8. ユーザー入力の取得とAI応答生成
 # =============================================================================
 user_input = st.chat_input("何か質問や話したいことがありますか？")
+turn_started = time.perf_counter()
 if user_input:
-    search_info = async_get_search_info(user_input) if use_internet else ""
-    
+    # クイズの回答には検索しない
     if st.session_state.get("quiz_active", False):
         if user_input.strip().lower() == st.session_state.quiz_answer.strip().lower():
             quiz_result = "正解です！おめでとうございます！"
         else:
             quiz_result = f"残念、不正解です。正解は {st.session_state.quiz_answer} です。"
-        st.session_state["messages"].append({"role": "クイズ", "content": quiz_result})
-        with st.chat_message("クイズ", avatar=avatar_img_dict.get("クイズ", "❓")):
-            st.markdown(
-                f'<div style="text-align: left;">'
-                f'<div class="chat-bubble">'
-                f'<div class="chat-header">クイズ</div>{quiz_result}'
-                f'</div></div>',
-                unsafe_allow_html=True,
-            )
+        conversation.append("クイズ", quiz_result)
+        render_message("クイズ", quiz_result)
         st.session_state.quiz_active = False
     else:
-        with st.chat_message("user", avatar=avatar_img_dict.get(USER_NAME)):
-            st.markdown(
-                f'<div style="text-align: right;">'
-                f'<div class="chat-bubble">'
-                f'<div class="chat-header">{user_name}</div>{user_input}'
-                f'</div></div>',
-                unsafe_allow_html=True,
-            )
-        st.session_state["messages"].append({"role": "user", "content": user_input})
+        # 検索は吹き出しの表示と並行して進める
+        search_future = start_search_info(user_input) if use_internet else None
+        render_message("user", user_input)
+        conversation.append("user", user_input)
+        context = build_conversation_context()
+        search_info = await_search_info(search_future)
         
-        if len(st.session_state["messages"]) == 1:
-            persona_params = adjust_parameters(user_input, ai_age)
-            discussion = generate_discussion_parallel(user_input, persona_params, ai_age, search_info=search_info)
-        else:
-            history = "\n".join(
-                f'{msg["role"]}: {msg["content"]}'
-                for msg in st.session_state["messages"]
-                if msg["role"] in NAMES or msg["role"] == NEW_CHAR_NAME
-            )
-            discussion = continue_discussion_parallel(user_input, history, ai_age, search_info=search_info)
-        
-        for line in discussion.split("\n"):
-            line = line.strip()
-            if line:
-                parts = line.split(":", 1)
-                role = parts[0]
-                content = parts[1].strip() if len(parts) > 1 else ""
-                st.session_state["messages"].append({"role": role, "content": content})
-                display_name = user_name if role == "user" else role
-                if role == "user":
-                    with st.chat_message("user", avatar=avatar_img_dict.get(USER_NAME)):
-                        st.markdown(
-                            f'<div style="text-align: right;">'
-                            f'<div class="chat-bubble">'
-                            f'<div class="chat-header">{display_name}</div>{content}'
-                            f'</div></div>',
-                            unsafe_allow_html=True,
-                        )
-                else:
-                    with st.chat_message(role, avatar=avatar_img_dict.get(role, "🤖")):
-                        st.markdown(
-                            f'<div style="text-align: left;">'
-                            f'<div class="chat-bubble">'
-                            f'<div class="chat-header">{display_name}</div>{content}'
-                            f'</div></div>',
-                            unsafe_allow_html=True,
-                        )
-                time.sleep(random.uniform(3, 10))
+        for role, content in render_discussion(
+            user_input, chat_engine.adjust_parameters(user_input, ai_age), ai_age, search_info=search_info, context=context
+        ):
+            conversation.append(role, content)
+    metrics.observe("turn", time.perf_counter() - turn_started)
 
 # =============================================================================
 # 9. 画像アップロード時の処理：写真を見た友達の会話開始（1回のみ）
 # =============================================================================
 if not st.session_state.get("quiz_active", False) and uploaded_image is not None:
     image_bytes = uploaded_image.getvalue()
-    image_hash = hashlib.md5(image_bytes).hexdigest()
+    image_hash = image_cache.content_hash(image_bytes)
     if st.session_state.last_uploaded_hash != image_hash:
         st.session_state.last_uploaded_hash = image_hash
         st.session_state.image_conversation_done = False
     if not st.session_state.get("image_conversation_done", False):
         # 内部で画像解析（解析結果は会話生成用にのみ利用し、表示はしない）
-        if image_hash in st.session_state["analyzed_images"]:
-            analysis_text = st.session_state["analyzed_images"][image_hash]
-        else:
-            pil_img = Image.open(BytesIO(image_bytes))
-            analysis_text = analyze_image_with_vit(pil_img)
-            st.session_state["analyzed_images"][image_hash] = analysis_text
+        try:
+            analysis_text = analyze_image_cached(image_bytes, image_hash)
+        except image_ingest.ImageRejected as e:
+            # 大きすぎる・読めない画像は会話を始めずに知らせる（同じ画像では繰り返さない）
+            st.warning(f"この画像は解析できません: {e}")
+            analysis_text = None
 
         # 友達全員が写真を直接見たかのように会話開始する（画像解析結果は表示しない）
-        conversation_among_friends = generate_discussion_parallel(
-            question="この写真を見た感想を教えてください。",
-            persona_params=adjust_parameters(analysis_text, ai_age),
-            ai_age=ai_age,
-            search_info=""
-        )
-        for line in conversation_among_friends.split("\n"):
-            line = line.strip()
-            if line:
-                parts = line.split(":", 1)
-                role = parts[0]
-                content = parts[1].strip() if len(parts) > 1 else ""
-                st.session_state["messages"].append({"role": role, "content": content})
-                if role == "user":
-                    with st.chat_message("user", avatar=avatar_img_dict.get(USER_NAME)):
-                        st.markdown(
-                            f'<div style="text-align: right;">'
-                            f'<div class="chat-bubble">'
-                            f'<div class="chat-header">{user_name}</div>{content}'
-                            f'</div></div>',
-                            unsafe_allow_html=True,
-                        )
-                else:
-                    with st.chat_message(role, avatar=avatar_img_dict.get(role, "🤖")):
-                        st.markdown(
-                            f'<div style="text-align: left;">'
-                            f'<div class="chat-bubble">'
-                            f'<div class="chat-header">{role}</div>{content}'
-                            f'</div></div>',
-                            unsafe_allow_html=True,
-                        )
-                time.sleep(random.uniform(3, 10))
+        if analysis_text is not None:
+            for role, content in render_discussion(
+                question=chat_engine.IMAGE_QUESTION,
+                persona_params=chat_engine.adjust_parameters(analysis_text, ai_age),
+                ai_age=ai_age,
+                search_info="",
+                # 画像へのコメントは対話のターンより後回しにする
+                priority=upstream_scheduler.PRIORITY_BACKGROUND,
+            ):
+                conversation.append(role, content)
         
         # 画像アップロード時の会話生成は1回のみ実施
         st.session_state.image_conversation_done = True
@@ -532,30 +546,19 @@ if not st.session_state.get("quiz_active", False) and uploaded_image is not None
         st.session_state["file_uploader_key"] = None
 
 # =============================================================================
-# 10. チャット履歴の表示
+# 10. チャット履歴の表示（新しい順、ページ単位）
 # =============================================================================
 st.header("会話履歴")
-if st.session_state["messages"]:
-    for msg in reversed(st.session_state["messages"]):
-        display_name = user_name if msg["role"] == "user" else msg["role"]
-        if msg["role"] == "user":
-            with st.chat_message("user", avatar=avatar_img_dict.get(USER_NAME)):
-                st.markdown(
-                    f'<div style="text-align: right;">'
-                    f'<div class="chat-bubble">'
-                    f'<div class="chat-header">{display_name}</div>{msg["content"]}'
-                    f'</div></div>',
-                    unsafe_allow_html=True,
-                )
-        else:
-            with st.chat_message(msg["role"], avatar=avatar_img_dict.get(msg["role"], "🤖")):
-                st.markdown(
-                    f'<div style="text-align: left;">'
-                    f'<div class="chat-bubble">'
-                    f'<div class="chat-header">{display_name}</div>{msg["content"]}'
-                    f'</div></div>',
-                    unsafe_allow_html=True,
-                )
+if len(conversation):
+    total_pages = chat_render.page_count(len(conversation))
+    history_page = 1
+    if total_pages > 1:
+        history_page = st.number_input(
+            f"ページ（全 {total_pages} ページ、1 が最新）", min_value=1, max_value=total_pages, value=1, step=1, key="history_page"
+        )
+    with metrics.timer("render_history"):
+        for msg in chat_render.newest_first_page(conversation, int(history_page)):
+            render_message(msg.role, msg.content)
 else:
     st.markdown("<p style='color: gray;'>ここに会話が表示されます。</p>", unsafe_allow_html=True)
 
@@ -565,4 +568,68 @@ else:
 st.sidebar.header("APIステータス")
 st.sidebar.write("【Gemini API】", st.session_state.gemini_status)
 st.sidebar.write("【tavily API】", st.session_state.tavily_status)
+for upstream_name in ("gemini", "tavily"):
+    upstream_status = upstream_scheduler.get_upstream(upstream_name).status()
+    st.sidebar.caption(
+        f"{upstream_name}: 回路 {upstream_status['state']}"
+        + (f"（再開まで {upstream_status['retry_after']:.0f} 秒）" if upstream_status["retry_after"] else "")
+        + f" / 待ち {upstream_status['queued']} 件"
+    )
+http_stats = http_client.get_stats()
+st.sidebar.caption(
+    f"HTTP: リクエスト {http_stats['requests']} / 新規接続 {http_stats['new_connections']} / "
+    f"再利用 {http_stats['reused_connections']} / 再試行 {http_stats['retries']} / "
+    f"タイムアウト {http_stats['timeouts']}"
+)
+gemini_cache_stats = response_cache.get_cache().stats()
+st.sidebar.caption(
+    f"Gemini 応答キャッシュ: ヒット {gemini_cache_stats['hits']} / 共有 {gemini_cache_stats['shared']} / "
+    f"{gemini_cache_stats['entries']} 件"
+)
+search_cache_stats = search_cache.get_cache().stats()
+st.sidebar.caption(
+    f"検索キャッシュ: ヒット {search_cache_stats['hits']} / ミス {search_cache_stats['misses']} / "
+    f"{search_cache_stats['entries']} 件"
+)
+try:
+    image_cache_stats = image_cache.get_cache().stats()
+    st.sidebar.caption(
+        f"画像解析キャッシュ: ヒット {image_cache_stats['hits']} / ミス {image_cache_stats['misses']} / "
+        f"{image_cache_stats['entries']} 件 / 削除 {image_cache_stats['evictions']}"
+    )
+except (sqlite3.Error, OSError) as e:
+    st.sidebar.caption(f"画像解析キャッシュ: 利用不可 ({e})")
+dedup_stats = image_dedup.get_index().stats()
+st.sidebar.caption(
+    f"近似重複の再利用: ヒット {dedup_stats['hits']} / 照会 {dedup_stats['lookups']} / "
+    f"登録 {dedup_stats['entries']} 件（距離 {dedup_stats['threshold']} 以内）"
+)
+st.sidebar.caption(
+    f"会話ログ: {len(conversation)} 件（メモリ上 {conversation.in_memory()} 件）/ ID {conversation.session_id[:8]}"
+    + ("" if conversation.persistent else "（保存できないためメモリのみ）")
+)
+with st.sidebar.expander("計測（ステージ別の所要時間）"):
+    timing_rows = metrics.timing_summary()
+    if timing_rows:
+        st.table([
+            {
+                "ステージ": row["stage"] + "".join(f" [{v}]" for v in row["labels"].values()),
+                "回数": row["count"],
+                "直近(ms)": round(row["last_ms"], 1),
+                "p50(ms)": round(row["p50_ms"], 1),
+                "p95(ms)": round(row["p95_ms"], 1),
+            }
+            for row in timing_rows
+        ])
+    for row in metrics.counter_summary():
+        st.caption(f"{row['name']} {row['labels']}: {row['value']:g}")
+    for latency_kind, kind_label in ((persona_latency.TOTAL, "応答"), (persona_latency.FIRST_TOKEN, "最初の断片")):
+        for row in persona_latency.get_policy().stats(latency_kind):
+            st.caption(
+                f"{NEW_CHAR_NAME if row['persona'] == chat_engine.NEW_CHARACTER_LABEL else row['persona']}（{kind_label}）: "
+                f"p50 {row['p50']:.1f} 秒 / p95 {row['p95']:.1f} 秒"
+                f"（{row['count']} 件、ヘッジまで {row['hedge_delay']:.1f} 秒）"
+            )
+    st.caption(f"ピーク RSS: {metrics.peak_rss_mb():.0f} MB")
+metrics.write_prometheus()
 st.sidebar.success("OK")
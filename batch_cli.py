@@ -0,0 +1,210 @@
+# =============================================================================
+# 一括生成（JSONL バッチ）
+#   質問または画像パスを1行1件の JSONL で受け取り、全ペルソナの回答を JSONL に書き出す。
+#   ブラウザのセッションを介さず chat_engine を直接使い、件数とペルソナの両方を並列に処理する。
+#
+#   入力（1行1件）:
+#     {"id": "faq-001", "question": "富士山の高さは？"}
+#     {"id": "img-001", "image": "photos/park.jpg"}
+#     任意: "context"（これまでの会話）、"ai_age"、"user_name"
+#     id を省略した場合は入力の行番号を id とする
+#   出力（1行1件、完了した順）:
+#     {"id", "question" / "image", "responses": {名前: 回答}, "ok", "status", "search_info",
+#      "analysis"（画像のみ）, "elapsed_ms", "new_character": [名前, 性格]}
+#
+#   出力ファイルがそのままチェックポイントになる。再実行すると出力済みの id は飛ばす
+#   （--retry-failed なら失敗した id だけやり直す。同じ id が複数行ある場合は最後の行が有効）。
+#   新キャラクターも出力から引き継ぐ（1つの出力に別の新キャラクターの回答が混ざらないようにする）。
+#
+#   使い方:
+#     GEMINI_API_KEY=... TAVILY_API_KEY=... python batch_cli.py faq.jsonl -o answers.jsonl --concurrency 8
+#     python batch_cli.py faq.jsonl -o answers.jsonl --mode single --search never
+#   API キーは環境変数、なければ .streamlit/secrets.toml（アプリと同じ形式）から読む。
+# =============================================================================
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import chat_engine
+import image_ingest
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SECRETS_PATH = os.path.join(BASE_DIR, ".streamlit", "secrets.toml")
+DEFAULT_AI_AGE = 30
+
+
+def load_api_keys(secrets_path: str = DEFAULT_SECRETS_PATH) -> Tuple[str, str]:
+    gemini_key = os.environ.get("GEMINI_API_KEY", "")
+    tavily_key = os.environ.get("TAVILY_API_KEY", "")
+    if (not gemini_key or not tavily_key) and os.path.exists(secrets_path):
+        try:
+            import tomllib  # Python 3.11以降の場合
+            with open(secrets_path, "rb") as f:
+                secrets = tomllib.load(f)
+        except ImportError:
+            import toml
+            secrets = toml.load(secrets_path)
+        gemini_key = gemini_key or secrets.get("general", {}).get("api_key", "")
+        tavily_key = tavily_key or secrets.get("tavily", {}).get("api_key", "")
+    if not gemini_key:
+        raise SystemExit("Gemini の API キーがありません（GEMINI_API_KEY または .streamlit/secrets.toml）")
+    return gemini_key, tavily_key
+
+
+def read_items(path: str) -> Iterator[dict]:
+    # 入力は先頭から1行ずつ読む（全件をメモリに載せない）
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                raise SystemExit(f"{path}:{line_no}: JSON として読めません ({e})")
+            if not isinstance(item, dict) or not (item.get("question") or item.get("image")):
+                raise SystemExit(f"{path}:{line_no}: question または image が必要です")
+            item.setdefault("id", str(line_no))
+            item["id"] = str(item["id"])
+            yield item
+
+
+def load_checkpoint(path: str, retry_failed: bool) -> Tuple[Set[str], Optional[Tuple[str, str]]]:
+    # (出力済みの id（--retry-failed なら成功した id のみ）, 出力で使った新キャラクター) を返す
+    if not os.path.exists(path):
+        return set(), None
+    latest: Dict[str, bool] = {}
+    new_character = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 中断時に書きかけになった最終行
+            latest[str(record.get("id"))] = bool(record.get("ok"))
+            if record.get("new_character"):
+                new_character = tuple(record["new_character"])
+    return {item_id for item_id, ok in latest.items() if ok or not retry_failed}, new_character
+
+
+def process_item(engine: chat_engine.ChatEngine, item: dict, new_character: Tuple[str, str],
+                 single_call: bool, use_search: bool, default_age: int, deadline: float = math.inf) -> dict:
+    started = time.perf_counter()
+    ai_age = int(item.get("ai_age", default_age))
+    record = {"id": item["id"]}
+    search_info, analysis = "", None
+    if item.get("image"):
+        record["image"] = item["image"]
+        image_ingest.check_bytes(os.path.getsize(item["image"]))  # 上限を超えるファイルは読み込まない
+        with open(item["image"], "rb") as f:
+            analysis = engine.analyze_image(f.read())
+        question = chat_engine.IMAGE_QUESTION
+        persona_params = chat_engine.adjust_parameters(analysis, ai_age)
+    else:
+        question = record["question"] = item["question"]
+        persona_params = chat_engine.adjust_parameters(question, ai_age)
+        if use_search:
+            future, _ = engine.start_search(question)
+            search_info = future.result().answer if future is not None else ""
+    agents = chat_engine.build_agents(persona_params, new_character)
+    responses, ok, status = engine.discussion(
+        agents, question, ai_age, search_info, item.get("context", ""),
+        item.get("user_name", chat_engine.DEFAULT_USER_NAME), single_call, deadline=deadline,
+    )
+    record.update({"responses": responses, "ok": ok, "status": status, "search_info": search_info})
+    if analysis is not None:
+        record["analysis"] = analysis
+    record["elapsed_ms"] = round((time.perf_counter() - started) * 1000)
+    return record
+
+
+def failed_record(item: dict, error: Exception) -> dict:
+    record = {"id": item["id"], "ok": False, "status": f"{type(error).__name__}: {error}", "responses": {}}
+    for key in ("question", "image"):
+        if key in item:
+            record[key] = item[key]
+    return record
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ペルソナ回答の一括生成（JSONL）")
+    parser.add_argument("input", help="入力 JSONL（question または image を含む）")
+    parser.add_argument("-o", "--output", required=True, help="出力 JSONL（チェックポイントを兼ねる）")
+    parser.add_argument("--concurrency", type=int, default=4, help="同時に処理する件数（ペルソナの並列度は PERSONA_MAX_CONCURRENCY）")
+    parser.add_argument("--mode", choices=("parallel", "single"), default="parallel", help="ペルソナごとに呼ぶか、1回のリクエストでまとめるか")
+    parser.add_argument("--search", choices=("auto", "never"), default="auto", help="auto なら検索要否の判定に従って検索する")
+    parser.add_argument("--ai-age", type=int, default=DEFAULT_AI_AGE, help="入力に ai_age がない場合の AI の年齢")
+    parser.add_argument("--new-character", help='新キャラクター（"名前:性格"、省略時は候補からランダムに1人）')
+    parser.add_argument("--deadline", type=float, default=0, help="1件あたりのペルソナ応答の期限（秒、0 で無期限。期限切れは失敗として記録）")
+    parser.add_argument("--retry-failed", action="store_true", help="出力済みでも失敗した id はやり直す")
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH, help="API キーを読む secrets.toml")
+    args = parser.parse_args()
+
+    gemini_key, tavily_key = load_api_keys(args.secrets)
+    engine = chat_engine.ChatEngine(gemini_key, tavily_key)
+    done_ids, new_character = load_checkpoint(args.output, args.retry_failed)
+    name, _, personality = (args.new_character or "").partition(":")
+    if name.strip() and personality.strip():
+        requested = chat_engine.pick_new_character(name, personality)
+        if new_character is not None and requested != new_character:
+            raise SystemExit(
+                f"{args.output} は新キャラクター {new_character[0]}（{new_character[1]}）で出力済みです"
+                "（別の新キャラクターで続ける場合は出力先を変えてください）"
+            )
+        new_character = requested
+    elif new_character is None:
+        # 出力に記録がなければ候補からランダムに選ぶ（以降の再実行は出力に記録した新キャラクターで続ける）
+        new_character = chat_engine.pick_new_character()
+    print(f"新キャラクター: {new_character[0]}（{new_character[1]}）", file=sys.stderr)
+
+    if done_ids:
+        print(f"出力済みの {len(done_ids)} 件を飛ばします", file=sys.stderr)
+    items = (item for item in read_items(args.input) if item["id"] not in done_ids)
+    single_call = args.mode == "single"
+    use_search = args.search == "auto"
+    deadline = args.deadline if args.deadline > 0 else math.inf
+
+    completed = failed = 0
+    started = time.perf_counter()
+    # 先読みは同時処理数の2倍まで（入力が大きくても未処理の件をため込まない）
+    max_pending = max(1, args.concurrency) * 2
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor, \
+            open(args.output, "a", encoding="utf-8") as out:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                future = executor.submit(process_item, engine, item, new_character, single_call, use_search, args.ai_age, deadline)
+                pending[future] = item
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = pending.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    record = failed_record(item, e)
+                record["new_character"] = list(new_character)
+                # 1件ごとに書き出す（中断しても完了した分は次回飛ばせる）
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                completed += 1
+                failed += 0 if record["ok"] else 1
+            elapsed = time.perf_counter() - started
+            print(f"\r完了 {completed} 件（失敗 {failed}）/ {completed / elapsed:.2f} 件/秒", end="", file=sys.stderr)
+        os.fsync(out.fileno())
+    print(file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
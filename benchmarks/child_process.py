@@ -0,0 +1,42 @@
+# =============================================================================
+# ベンチマークの子プロセス実行
+#   計測は条件ごとに別プロセスで行う（ピーク RSS・プロセス共通のキャッシュを持ち越さない）。
+#   子プロセスが異常終了（モデルのダウンロード失敗・メモリ不足・import エラーなど）しても
+#   親が待ち続けないよう、生存と期限を確認しながら結果を受け取る。
+# =============================================================================
+import queue
+import time
+from typing import Callable, Optional, Tuple
+
+POLL_INTERVAL = 1.0
+
+
+def run_child(ctx, target: Callable, args: tuple, timeout: float) -> Tuple[Optional[dict], str]:
+    """
+    target(*args, result_queue) を別プロセスで実行し、result_queue に入れられた結果を返す。
+    戻り値は (結果, "") または (None, 失敗の理由)。
+    """
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=target, args=args + (result_queue,))
+    proc.start()
+    deadline = time.monotonic() + timeout
+    result, error = None, ""
+    while result is None:
+        try:
+            result = result_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if not proc.is_alive():
+                # 終了直前に入れた結果がまだ届いていない場合に備えて、もう一度だけ待つ
+                try:
+                    result = result_queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    error = f"子プロセスが結果を返さずに終了しました（終了コード {proc.exitcode}）"
+                break
+            if time.monotonic() >= deadline:
+                error = f"{timeout:.0f} 秒以内に終了しませんでした"
+                break
+    proc.join(timeout=POLL_INTERVAL * 5)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join()
+    return result, error
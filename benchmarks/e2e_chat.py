@@ -0,0 +1,246 @@
+# =============================================================================
+# チャットのオフライン E2E ベンチマーク（API キー・ネットワーク不要）
+#   - Gemini / Tavily をローカルの代替サーバー（stub_servers.py）に置き換える
+#   - Streamlit の AppTest でアプリ（AI_agent.py）を同時接続数ぶん起動し、
+#     台本どおりのチャットのターンを流す
+#   - 同時接続数ごとに別プロセスで実行し、以下を表示する
+#       - ターンのレイテンシ p50 / p95 / p99（ms、AppTest の再実行1回ぶん。画像は別集計）
+#       - スループット（ターン/秒）とピーク RSS（MB）
+#       - 代替サーバーへのリクエスト数と、アプリ内のステージ別計測（metrics）
+#
+#   使い方:
+#     python benchmarks/e2e_chat.py --concurrency 1,4,8 --turns 5
+#     python benchmarks/e2e_chat.py --mode single --gemini-latency 1.5 --error-rate 0.05 --json result.json
+#     python benchmarks/e2e_chat.py --images ./sample_images   # ViT の経路も同時に流す
+#
+#   AppTest はファイルアップロードを操作できないため、--images の画像は
+#   アプリと同じ経路（画像解析キャッシュ → ViT 推論）をセッションのスレッドから直接呼ぶ。
+#   Streamlit 1.28 以降が必要。子プロセスが異常終了した・期限を過ぎた同時接続数は「失敗」として表示する。
+# =============================================================================
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import child_process  # noqa: E402
+import stub_servers  # noqa: E402
+from metrics import percentile  # noqa: E402
+
+APP_PATH = os.path.join(ROOT, "AI_agent.py")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+STUB_SECRETS = {"general": {"api_key": "stub"}, "tavily": {"api_key": "stub"}}
+# 雑談（検索なし）と、検索が必要な質問を混ぜた既定の台本
+DEFAULT_SCRIPT = [
+    "こんにちは！",
+    "今日の東京の天気はどうですか？",
+    "最近おすすめの本を教えて",
+    "富士山の高さはどれくらいですか？",
+    "なるほど、ありがとう",
+    "週末は何をして過ごすのが好き？",
+    "最新のスマートフォンの価格はいくら？",
+]
+# --mode と、サイドバーの表示設定（チェックボックスのキー）の対応
+MODES = {
+    "stream": {"streaming_mode": True, "single_call_mode": False},
+    "parallel": {"streaming_mode": False, "single_call_mode": False},
+    "single": {"streaming_mode": False, "single_call_mode": True},
+}
+
+
+def load_script(path: str) -> list:
+    if not path:
+        return DEFAULT_SCRIPT
+    with open(path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if not lines:
+        raise SystemExit(f"台本が空です: {path}")
+    return lines
+
+
+def list_images(image_dir: str) -> list:
+    if not image_dir:
+        return []
+    paths = [
+        os.path.join(image_dir, name)
+        for name in sorted(os.listdir(image_dir))
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+    if not paths:
+        raise SystemExit(f"画像が見つかりません: {image_dir}")
+    return paths
+
+
+def benchmark_env(base_url: str, cache_dir: str, level: int, warm_caches: bool, keep_limits: bool) -> dict:
+    # 子プロセスはこの環境変数を引き継ぐ（各モジュールは import 時に環境変数を読む）
+    env = {
+        "GEMINI_BASE_URL": base_url,
+        "TAVILY_BASE_URL": base_url,
+        "IMAGE_CACHE_PATH": os.path.join(cache_dir, f"image_analysis_{level}.sqlite3"),
+        "CONVERSATION_DB_PATH": os.path.join(cache_dir, f"conversations_{level}.sqlite3"),
+    }
+    if not warm_caches:
+        # 同じ台本を繰り返すため、キャッシュを切ってペルソナの呼び出しを毎回発生させる
+        env.update({"GEMINI_CACHE_TTL": "0", "SEARCH_CACHE_TTL": "0", "SEARCH_CACHE_NEGATIVE_TTL": "0"})
+    if not keep_limits:
+        # 代替サーバー相手に本番の流量制限で待たされないようにする
+        env.update({"GEMINI_RPM": "0", "GEMINI_TPM": "0", "TAVILY_RPM": "0"})
+    return env
+
+
+def analyze_image(path: str) -> None:
+    # アプリと同じ経路（chat_engine: ディスクキャッシュ → ViT 推論）。画像解析に API キーは不要
+    import chat_engine
+
+    with open(path, "rb") as f:
+        chat_engine.ChatEngine("").analyze_image(f.read())
+
+
+def run_session(index: int, script: list, turns: int, mode: str, images: list, timeout: float,
+                start_barrier: threading.Barrier, latencies: list, image_latencies: list, errors: list) -> None:
+    from streamlit.testing.v1 import AppTest
+
+    try:
+        at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        for section, values in STUB_SECRETS.items():
+            at.secrets[section] = values
+        # 初回の描画（モデル・アイコンの読み込みなど）は計測に含めない
+        at.run()
+        for key, value in MODES[mode].items():
+            at.checkbox(key=key).set_value(value)
+        at.run()
+    except Exception as e:
+        errors.append(f"セッション {index} の起動に失敗: {e}")
+        start_barrier.wait()  # 他のセッションを待たせたままにしない
+        return
+    start_barrier.wait()
+    for turn in range(turns):
+        is_image = bool(images) and turn % 2 == 1
+        start = time.perf_counter()
+        try:
+            if is_image:
+                analyze_image(images[(index + turn) % len(images)])
+            else:
+                at.chat_input[0].set_value(script[(index + turn) % len(script)]).run()
+                if at.exception:
+                    errors.append(at.exception[0].message)
+        except Exception as e:
+            errors.append(str(e))
+        (image_latencies if is_image else latencies).append((time.perf_counter() - start) * 1000)
+
+
+def run_level(concurrency: int, script: list, turns: int, mode: str, images: list, timeout: float, result_queue) -> None:
+    # 別プロセスで実行されるため、ピーク RSS とプロセス共通のキャッシュ・計測はこの同時接続数だけの値になる
+    try:
+        from streamlit.testing.v1 import AppTest  # noqa: F401
+    except ImportError:
+        result_queue.put({"concurrency": concurrency, "error": "streamlit.testing（Streamlit 1.28 以降）が必要です"})
+        return
+    import metrics
+
+    latencies, image_latencies, errors = [], [], []
+    start_barrier = threading.Barrier(concurrency + 1)
+    threads = [
+        threading.Thread(target=run_session, args=(i, script, turns, mode, images, timeout, start_barrier, latencies, image_latencies, errors))
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    result_queue.put({
+        "concurrency": concurrency,
+        "turns": len(latencies),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "p50_ms": statistics.median(latencies) if latencies else 0.0,
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "image_turns": len(image_latencies),
+        "image_p50_ms": statistics.median(image_latencies) if image_latencies else 0.0,
+        "image_p95_ms": percentile(image_latencies, 95),
+        "throughput": (len(latencies) + len(image_latencies)) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": metrics.peak_rss_mb(),
+        "stages": metrics.timing_summary(),
+        "counters": metrics.counter_summary(),
+    })
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="チャットのオフライン E2E ベンチマーク")
+    parser.add_argument("--concurrency", default="1,4,8", help="同時接続数（カンマ区切り）")
+    parser.add_argument("--turns", type=int, default=5, help="1セッションあたりのターン数")
+    parser.add_argument("--mode", choices=list(MODES), default="stream", help="回答の生成・表示モード")
+    parser.add_argument("--script", help="台本ファイル（1行1発言、省略時は既定の台本）")
+    parser.add_argument("--images", help="画像フォルダ（指定すると1ターンおきに ViT の経路を流す）")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1ターンのタイムアウト（秒）")
+    parser.add_argument("--level-timeout", type=float, default=0, help="同時接続数1段階あたりの上限（秒、0 なら ターン数×タイムアウト＋120）")
+    parser.add_argument("--warm-caches", action="store_true", help="応答・検索キャッシュを有効のまま計測する")
+    parser.add_argument("--keep-limits", action="store_true", help="上流の流量制限（RPM/TPM）を有効のまま計測する")
+    parser.add_argument("--json", dest="json_path", help="結果を JSON で保存するパス")
+    stub_servers.add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    script = load_script(args.script)
+    images = list_images(args.images)
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    server = stub_servers.start_stub_server(*stub_servers.configs_from_args(args))
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for level in levels:
+            # 同時接続数ごとに画像解析キャッシュと会話ログを作り直す（前の計測のヒットを持ち越さない）
+            os.environ.update(benchmark_env(server.base_url, tmp_dir, level, args.warm_caches, args.keep_limits))
+            before = dict(server.requests)
+            level_timeout = args.level_timeout or args.turns * args.timeout + 120
+            result, error = child_process.run_child(
+                ctx, run_level, (level, script, args.turns, args.mode, images, args.timeout), level_timeout
+            )
+            if result is None:
+                result = {"concurrency": level, "failed": error}
+            elif "error" in result:
+                raise SystemExit(result["error"])
+            result["upstream_requests"] = {name: count - before.get(name, 0) for name, count in server.requests.items()}
+            results.append(result)
+    server.shutdown()
+
+    print(f"モード {args.mode} / ターン {args.turns} / Gemini 遅延 {args.gemini_latency}s / エラー率 {args.error_rate:.0%}")
+    print(f"{'同時':>6}{'ターン':>8}{'失敗':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}"
+          f"{'turn/s':>8}{'RSS(MB)':>9}{'gemini':>8}{'tavily':>8}")
+    for result in results:
+        if "failed" in result:
+            print(f"{result['concurrency']:>6}  失敗: {result['failed']}")
+            continue
+        print(
+            f"{result['concurrency']:>6}{result['turns']:>8}{result['errors']:>6}"
+            f"{result['p50_ms']:>10.0f}{result['p95_ms']:>10.0f}{result['p99_ms']:>10.0f}"
+            f"{result['throughput']:>8.2f}{result['peak_rss_mb']:>9.0f}"
+            f"{result['upstream_requests'].get('gemini', 0):>8}{result['upstream_requests'].get('tavily', 0):>8}"
+        )
+        if result["image_turns"]:
+            print(f"{'':>6}  画像 {result['image_turns']} 件: p50 {result['image_p50_ms']:.0f}ms / p95 {result['image_p95_ms']:.0f}ms")
+    completed = [result for result in results if "failed" not in result]
+    if completed:
+        print("\nステージ別（完了した最大の同時接続数）")
+    for row in (completed[-1]["stages"] if completed else []):
+        label = row["stage"] + "".join(f" [{v}]" for v in row["labels"].values())
+        print(f"  {label:<36}{row['count']:>6}{row['p50_ms']:>10.0f}{row['p95_ms']:>10.0f}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# =============================================================================
+# Gemini / Tavily のローカル代替サーバー（オフラインのベンチマーク用）
+#   - POST /v1beta/models/<model>:generateContent          … Gemini と同じ形の JSON
+#   - POST /v1beta/models/<model>:streamGenerateContent    … SSE（data: 行）で断片を返す
+#   - POST /search                                         … Tavily と同じ形の JSON
+#   遅延（平均とゆらぎ）・最初の断片までの遅延・エラー率は API ごとに設定できる。
+#
+#   単体で起動する場合:
+#     python benchmarks/stub_servers.py --port 8765 --gemini-latency 0.8 --error-rate 0.02
+#   表示される GEMINI_BASE_URL / TAVILY_BASE_URL を設定してアプリを起動する。
+# =============================================================================
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+_PERSONA_LINE = re.compile(r"^- (.+?): 【", re.MULTILINE)
+
+
+class StubConfig:
+    def __init__(self, latency: float = 0.5, jitter: float = 0.3, first_token: float = 0.2,
+                 chunks: int = 5, error_rate: float = 0.0, error_status: int = 503):
+        self.latency = latency          # 応答完了までの平均秒数
+        self.jitter = jitter            # 平均に対するゆらぎの割合（0.3 なら ±30%）
+        self.first_token = first_token  # ストリーミングで最初の断片を返すまでの秒数
+        self.chunks = chunks            # ストリーミングの断片数
+        self.error_rate = error_rate    # エラーを返す確率
+        self.error_status = error_status
+
+    def delay(self) -> float:
+        return max(0.0, random.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter)))
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+def fake_text(prompt: str) -> str:
+    # 文字数だけそれらしく揃えた固定文（プロンプトの長さに応じて少し変える）
+    return f"（テスト応答 {len(prompt) % 97}）それは面白い話題ですね。私はこう考えます。"
+
+
+def fake_group_response(prompt: str) -> str:
+    # 一括生成モード（responseSchema 指定）向けに、プロンプトに列挙された全員分の回答を返す
+    names = _PERSONA_LINE.findall(prompt)
+    return json.dumps(
+        {"responses": [{"name": name, "response": fake_text(prompt + name)} for name in names]},
+        ensure_ascii=False,
+    )
+
+
+def gemini_body(text: str) -> dict:
+    return {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}}]}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # http_client のコネクション再利用を再現する
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, config: StubConfig) -> None:
+        self._send_json(config.error_status, {"error": {"code": config.error_status, "message": "stub error"}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self._read_json()
+        self.server.count(path)
+        if path == "/search":
+            self._search(payload)
+        elif path.endswith(":generateContent"):
+            self._generate(payload)
+        elif path.endswith(":streamGenerateContent"):
+            self._stream(payload)
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": f"unknown path {path}"}})
+
+    def _prompt(self, payload: dict) -> str:
+        return "".join(part.get("text", "") for content in payload.get("contents", []) for part in content.get("parts", []))
+
+    def _generate(self, payload: dict) -> None:
+        config = self.server.gemini
+        time.sleep(config.delay())
+        if config.fails():
+            return self._send_error(config)
+        prompt = self._prompt(payload)
+        if payload.get("generationConfig", {}).get("responseMimeType") == "application/json":
+            text = fake_group_response(prompt)
+        else:
+            text = fake_text(prompt)
+        self._send_json(200, gemini_body(text))
+
+    def _stream(self, payload: dict) -> None:
+        config = self.server.gemini
+        time.sleep(min(config.first_token, config.latency))
+        if config.fails():
+            return self._send_error(config)
+        text = fake_text(self._prompt(payload))
+        chunks = max(1, config.chunks)
+        size = -(-len(text) // chunks)
+        # 残りの遅延を断片の間に均等に割り振る
+        gap = max(0.0, config.delay() - config.first_token) / chunks
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(0, len(text), size):
+            event = f"data: {json.dumps(gemini_body(text[i:i + size]), ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+            self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+            self.wfile.flush()
+            time.sleep(gap)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _search(self, payload: dict) -> None:
+        config = self.server.tavily
+        time.sleep(config.delay())
+        if config.fails():
+            return self._send_error(config)
+        query = payload.get("query", "")
+        self._send_json(200, {
+            "query": query,
+            "answer": f"「{query}」についてのテスト用の検索結果です。",
+            "results": [{"title": "stub", "url": "http://localhost/stub", "content": "stub", "score": 1.0}],
+            "response_time": config.latency,
+        })
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, gemini: StubConfig, tavily: StubConfig):
+        super().__init__(address, _Handler)
+        self.gemini = gemini
+        self.tavily = tavily
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def count(self, path: str) -> None:
+        key = "tavily" if path == "/search" else "gemini"
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(gemini: StubConfig = None, tavily: StubConfig = None, host: str = "127.0.0.1", port: int = 0) -> StubServer:
+    # port=0 なら空いているポートを使う。サーバーはデーモンスレッドで動く
+    server = StubServer((host, port), gemini or StubConfig(), tavily or StubConfig(latency=0.3, chunks=1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--gemini-latency", type=float, default=0.8, help="Gemini の平均応答時間（秒）")
+    parser.add_argument("--first-token", type=float, default=0.3, help="ストリーミングの最初の断片までの秒数")
+    parser.add_argument("--chunks", type=int, default=5, help="ストリーミングの断片数")
+    parser.add_argument("--tavily-latency", type=float, default=0.4, help="Tavily の平均応答時間（秒）")
+    parser.add_argument("--jitter", type=float, default=0.3, help="応答時間のゆらぎ（平均に対する割合）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラー（503）を返す確率")
+
+
+def configs_from_args(args) -> tuple:
+    gemini = StubConfig(args.gemini_latency, args.jitter, args.first_token, args.chunks, args.error_rate)
+    tavily = StubConfig(args.tavily_latency, args.jitter, 0.0, 1, args.error_rate)
+    return gemini, tavily
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Gemini / Tavily のローカル代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_stub_server(*configs_from_args(args), host=args.host, port=args.port)
+    print(f"GEMINI_BASE_URL={server.base_url}")
+    print(f"TAVILY_BASE_URL={server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# =============================================================================
+# ViT モデル階層のオフラインベンチマーク
+#   ローカルの画像フォルダに対して各階層を実行し、以下を表示する
+#     - 1枚あたりの推論レイテンシ p50 / p95（ms）
+#     - ピーク RSS（MB、階層ごとに別プロセスで計測）
+#     - fp32 ベースライン（ViT-Large）との top-1 / top-3 一致率
+#
+#   使い方:
+#     python benchmarks/vit_tiers.py ./sample_images --tiers large,large-int8,base,small
+#     python benchmarks/vit_tiers.py ./sample_images --tta none --json result.json
+#   子プロセスが異常終了した・--timeout 秒を過ぎた階層は「失敗」として表示し、残りの階層を続ける。
+# =============================================================================
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import child_process  # noqa: E402
+import image_analysis  # noqa: E402
+import image_ingest  # noqa: E402
+from metrics import peak_rss_mb, percentile  # noqa: E402
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def list_images(image_dir: str) -> list:
+    paths = [
+        os.path.join(image_dir, name)
+        for name in sorted(os.listdir(image_dir))
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+    if not paths:
+        raise SystemExit(f"画像が見つかりません: {image_dir}")
+    return paths
+
+
+def run_tier(tier: str, paths: list, augmentations: tuple, repeat: int, result_queue) -> None:
+    # 別プロセスで実行されるため、ピーク RSS はこの階層だけの値になる
+    extractor, model = image_analysis.load_model(tier)
+    # アプリと同じ取り込み（縮小デコード・EXIF の向き補正）を通す
+    images = [image_ingest.load_image_file(path) for path in paths]
+    # ウォームアップ（初回の遅延を計測から除く）
+    image_analysis.predict_logits(images[0], extractor, model, augmentations)
+    latencies = []
+    predictions = []
+    for image in images:
+        for i in range(repeat):
+            start = time.perf_counter()
+            avg_logits = image_analysis.predict_logits(image, extractor, model, augmentations)
+            latencies.append((time.perf_counter() - start) * 1000)
+        predictions.append(avg_logits.topk(image_analysis.TOP_K).indices.tolist())
+    # モデルごとにラベル ID の並びが異なる可能性があるため、ラベル名で比較する
+    labels = [[model.config.id2label[idx] for idx in top] for top in predictions]
+    result_queue.put({
+        "tier": tier,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": percentile(latencies, 95),
+        "peak_rss_mb": peak_rss_mb(),
+        "labels": labels,
+    })
+
+
+def agreement(labels: list, baseline: list) -> tuple:
+    top1 = sum(1 for mine, base in zip(labels, baseline) if mine[0] == base[0])
+    # top-3 はラベル集合の重なり率の平均
+    top3 = sum(len(set(mine) & set(base)) / len(base) for mine, base in zip(labels, baseline))
+    return top1 / len(baseline), top3 / len(baseline)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="ViT モデル階層の精度・速度比較")
+    parser.add_argument("image_dir", help="ローカル画像フォルダ（png / jpg）")
+    parser.add_argument("--tiers", default=",".join(image_analysis.MODEL_TIERS), help="比較する階層（カンマ区切り）")
+    parser.add_argument("--tta", default=",".join(image_analysis.TTA_CONFIG), help='TTA 拡張（"none" で無効）')
+    parser.add_argument("--repeat", type=int, default=3, help="1枚あたりの計測回数")
+    parser.add_argument("--timeout", type=float, default=1800.0, help="1階層あたりの上限（秒、モデルのダウンロードを含む）")
+    parser.add_argument("--json", dest="json_path", help="結果を JSON で保存するパス")
+    args = parser.parse_args()
+
+    paths = list_images(args.image_dir)
+    augmentations = image_analysis.parse_tta(args.tta)
+    tiers = [tier.strip() for tier in args.tiers.split(",") if tier.strip()]
+    if image_analysis.BASELINE_TIER not in tiers:
+        tiers.insert(0, image_analysis.BASELINE_TIER)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for tier in tiers:
+        result, error = child_process.run_child(ctx, run_tier, (tier, paths, augmentations, args.repeat), args.timeout)
+        results[tier] = result if result is not None else {"tier": tier, "error": error}
+
+    baseline = results[image_analysis.BASELINE_TIER].get("labels")
+    print(f"画像 {len(paths)} 枚 / TTA {','.join(augmentations)} / 繰り返し {args.repeat}")
+    if baseline is None:
+        print(f"ベースライン（{image_analysis.BASELINE_TIER}）が失敗したため、一致率は表示しません")
+    print(f"{'tier':<12}{'p50(ms)':>10}{'p95(ms)':>10}{'RSS(MB)':>10}{'top1一致':>10}{'top3一致':>10}")
+    for tier in tiers:
+        result = results[tier]
+        if "error" in result:
+            print(f"{tier:<12}  失敗: {result['error']}")
+            continue
+        line = f"{tier:<12}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['peak_rss_mb']:>10.0f}"
+        if baseline is not None:
+            top1, top3 = agreement(result["labels"], baseline)
+            result["top1_agreement"], result["top3_agreement"] = top1, top3
+            line += f"{top1:>10.1%}{top3:>10.1%}"
+        print(line)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,601 @@
+# =============================================================================
+# 会話エンジン（Streamlit に依存しない部分）
+#   - Gemini / Tavily の呼び出し（流量制限・応答キャッシュ・計測つき）
+#   - ペルソナ（ChatAgent）のプロンプト組み立て、並列生成・一括生成・ストリーミング
+#     （並列生成はターンの期限つき。遅いペルソナには重複リクエスト（ヘッジ）を出し、先に届いた方を使う）
+#   - 画像解析（ディスクキャッシュ → ViT 推論）と会話コンテキストの要約
+#   画面（AI_agent.py）と一括処理（batch_cli.py）の両方から使う。
+#   状態は持たず、呼び出し結果のステータスは戻り値で返す（表示側が session_state などに保存する）。
+# =============================================================================
+import json
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import conversation_context
+import http_client
+import image_analysis
+import image_cache
+import image_dedup
+import image_ingest
+import metrics
+import persona_latency
+import persona_orchestrator
+import response_cache
+import search_cache
+import search_gate
+import upstream_scheduler
+import vit_worker
+
+MODEL_NAME = "gemini-2.0-flash-001"
+GEMINI_BASE_URL = os.environ.get("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+TAVILY_BASE_URL = os.environ.get("TAVILY_BASE_URL", "https://api.tavily.com").rstrip("/")
+
+GEMINI_BUSY_MESSAGE = "ただいま混み合っているようです。少し時間をおいてから、もう一度話しかけてください。"
+PERSONA_LATE_MESSAGE = "（考え中… 回答が届き次第、次の表示で追加します）"
+OUTPUT_TOKENS_ESTIMATE = 400  # TPM 制限の見積もりに使う1回あたりの出力トークン数
+DEFAULT_USER_NAME = "ユーザー"
+IMAGE_QUESTION = "この写真を見た感想を教えてください。"
+
+# 新キャラクターの候補（名前・性格の指定がないときにランダムに選ぶ）
+NEW_CHARACTER_CANDIDATES = [
+    ("たけし", "冷静沈着で皮肉屋、どこか孤高な存在"),
+    ("さとる", "率直かつ辛辣で、常に現実を鋭く指摘する"),
+    ("りさ", "自由奔放で斬新なアイデアを持つ、ユニークな感性の持ち主"),
+    ("けんじ", "クールで合理的、論理に基づいた意見を率直に述べる"),
+    ("なおみ", "独創的で個性的、常識にとらわれず新たな視点を提供する"),
+]
+
+# 全ペルソナの回答を1回のリクエストで生成するための JSON スキーマ
+GROUP_RESPONSE_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": {
+        "type": "OBJECT",
+        "properties": {
+            "responses": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "name": {"type": "STRING"},
+                        "response": {"type": "STRING"},
+                    },
+                    "required": ["name", "response"],
+                },
+            },
+        },
+        "required": ["responses"],
+    },
+}
+
+
+class Reply(NamedTuple):
+    text: str
+    ok: bool
+    status: str  # 画面のサイドバーに出すステータス文字列
+
+
+def remove_json_artifacts(text: str, pattern: str = r"'parts': \[\{'text':.*?\}\], 'role': 'model'") -> str:
+    if not isinstance(text, str):
+        text = str(text) if text else ""
+    cleaned = re.sub(pattern, "", text, flags=re.DOTALL)
+    return cleaned.strip()
+
+
+def pick_new_character(name: str = "", personality: str = "") -> Tuple[str, str]:
+    if name.strip() and personality.strip():
+        return name.strip(), personality.strip()
+    return random.choice(NEW_CHARACTER_CANDIDATES)
+
+
+# 固定のペルソナ。新キャラクターの名前は自由入力のため、計測のラベルやヒストグラムのキーには
+# persona_label() で1つにまとめた名前を使う（ラベルの種類が際限なく増えないように）
+PERSONA_NAMES = ("ゆかり", "しんや", "みのる")
+NEW_CHARACTER_LABEL = "new"
+
+
+def persona_label(name: str) -> str:
+    return name if name in PERSONA_NAMES else NEW_CHARACTER_LABEL
+
+
+def adjust_parameters(input_text, ai_age):
+    return {
+       "ゆかり": {"style": "温かく優しい", "detail": "実際に写真を見たかのように、感想を述べます"},
+       "しんや": {"style": "冷静沈着", "detail": "写真から感じた現実的な印象を分析します"},
+       "みのる": {"style": "ユーモアたっぷり", "detail": "写真の面白さや細かい所を冗談交じりにコメントします"}
+    }
+
+
+class ChatAgent:
+    def __init__(self, name, style, detail):
+        self.name = name
+        self.style = style
+        self.detail = detail
+
+    def build_prompt(self, question: str, ai_age: int, search_info: str = "", current_user: str = DEFAULT_USER_NAME, context: str = "") -> str:
+        prompt = f"【これまでの会話】\n{context}\n\n" if context else ""
+        prompt += f"【{current_user}さんの質問】\n{question}\n\n"
+        if search_info:
+            prompt += f"最新情報によると、{search_info}という報告があります。\n"
+        prompt += f"このAIは{ai_age}歳として振る舞います。\n"
+        prompt += f"{self.name}は【{self.style}な視点】で、{self.detail}。\n"
+        prompt += "あなたの回答のみを出力してください。"
+        return prompt
+
+
+def build_agents(persona_params: dict, new_character: Optional[Tuple[str, str]] = None) -> List[ChatAgent]:
+    agents = [ChatAgent(name, params["style"], params["detail"]) for name, params in persona_params.items()]
+    if new_character:
+        agents.append(ChatAgent(new_character[0], new_character[1], ""))
+    return agents
+
+
+def build_group_prompt(question: str, agents: Sequence[ChatAgent], ai_age: int, search_info: str = "",
+                       current_user: str = DEFAULT_USER_NAME, context: str = "") -> str:
+    # 質問・検索結果・会話コンテキストは1回だけ渡し、各ペルソナの設定を列挙する
+    prompt = f"【これまでの会話】\n{context}\n\n" if context else ""
+    prompt += f"【{current_user}さんの質問】\n{question}\n\n"
+    if search_info:
+        prompt += f"最新情報によると、{search_info}という報告があります。\n"
+    prompt += f"このAIは{ai_age}歳として振る舞います。\n"
+    prompt += "以下の登場人物が、それぞれの視点で質問に答えます。\n"
+    for agent in agents:
+        prompt += f"- {agent.name}: 【{agent.style}な視点】で、{agent.detail}。\n"
+    prompt += (
+        "各登場人物の回答を responses 配列に name（登場人物の名前をそのまま）と response の組で出力してください。"
+        "response には本人の回答のみを書いてください。"
+    )
+    return prompt
+
+
+def parse_group_response(text: str, agents: Sequence[ChatAgent]) -> Optional[Dict[str, str]]:
+    # 全員分の回答がそろっていれば {名前: 回答} を、そうでなければ None を返す
+    try:
+        data = json.loads(text)
+        items = data["responses"] if isinstance(data, dict) else data
+        responses = {
+            str(item["name"]).strip(): remove_json_artifacts(item["response"])
+            for item in items
+        }
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not all(responses.get(agent.name) for agent in agents):
+        return None
+    return {agent.name: responses[agent.name] for agent in agents}
+
+
+class _Race:
+    """
+    同じペルソナへの試行（本リクエストとヘッジ）。最初に成功した応答を future の結果にする。
+    全試行が失敗した場合は最後の失敗を結果にする。成功までの所要時間は persona_latency に記録する
+    （期限後に届いた分も含める。遅い側を学習しないとヘッジが早すぎる）。
+    """
+
+    def __init__(self, name: str, prompt: str, started: float):
+        self.name = name
+        self.label = persona_label(name)
+        self.prompt = prompt
+        self.started = started
+        self.future = Future()
+        self.hedged = False  # ヘッジの要否を判断済みか（予算切れで出さなかった場合も True）
+        self.hedge_sent = False
+        self.hedge_won = False
+        self._attempts = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def add(self, attempt: Future, hedge: bool = False) -> None:
+        with self._lock:
+            self._attempts += 1
+        attempt.add_done_callback(lambda f: self._settle(f, hedge))
+
+    def _settle(self, attempt: Future, hedge: bool) -> None:
+        try:
+            reply = attempt.result()
+        except Exception as e:
+            reply = Reply(f"エラー: リクエスト送信時に例外が発生しました -> {str(e)}", False, f"Gemini API Exception: {str(e)}")
+        with self._lock:
+            if self.future.done():
+                return
+            if not reply.ok:
+                self._failures += 1
+                if self._failures < self._attempts:
+                    return  # もう一方の試行を待つ
+            self.hedge_won = hedge
+            self.future.set_result(reply)
+        if reply.ok:
+            persona_latency.get_policy().observe(self.label, time.perf_counter() - self.started)
+
+
+def _stream_reply(text: str) -> Optional[tuple]:
+    # ストリーミングの全文から応答キャッシュに入れる値を作る（空なら入れない）
+    content = remove_json_artifacts(text)
+    return (content, True, "Gemini API: OK") if content else None
+
+
+def _parse_gemini_text(rjson: dict) -> Tuple[str, str]:
+    # (本文, 本文が取れなかった理由) を返す
+    candidates = rjson.get("candidates", [])
+    if not candidates:
+        return "", "candidatesが空"
+    content_val = candidates[0].get("content", "")
+    if isinstance(content_val, dict):
+        content_str = " ".join([p.get("text", "") for p in content_val.get("parts", [])])
+    else:
+        content_str = str(content_val)
+    content_str = content_str.strip()
+    if not content_str:
+        return "", "contentが空"
+    return content_str, ""
+
+
+class ChatEngine:
+    """
+    API キーを持つ会話エンジン。キャッシュ・流量制限・共有ループはプロセス共通のため、
+    インスタンスは使い捨てでよい（Streamlit の再実行ごとに作り直しても状態は失われない）。
+    """
+
+    def __init__(self, gemini_api_key: str, tavily_api_key: str = "", model_name: str = MODEL_NAME):
+        self.gemini_api_key = gemini_api_key
+        self.tavily_api_key = tavily_api_key
+        self.model_name = model_name
+
+    # ---- Gemini ---------------------------------------------------------------
+    def _gemini_url(self, method: str) -> str:
+        query = "alt=sse&" if method == "streamGenerateContent" else ""
+        return f"{GEMINI_BASE_URL}/v1beta/models/{self.model_name}:{method}?{query}key={self.gemini_api_key}"
+
+    def _post_gemini(self, url: str, payload: dict, prompt: str, priority: int, **kwargs):
+        # プロセス共通の流量制限・サーキットブレーカーを通して送信する（429 / 5xx と例外を失敗として記録）
+        return upstream_scheduler.get_upstream("gemini").call(
+            lambda: http_client.post(url, json=payload, headers={"Content-Type": "application/json"}, **kwargs),
+            priority=priority,
+            cost=conversation_context.estimate_tokens(prompt) + OUTPUT_TOKENS_ESTIMATE,
+            is_failure=lambda response: upstream_scheduler.retryable_status(response.status_code),
+        )
+
+    def request_gemini(self, prompt: str, generation_config: dict = None,
+                       priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> Reply:
+        # キャッシュを通さずに1回呼び出す
+        payload = {"contents": [{"parts": [{"text": prompt}]}]}
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        try:
+            response = self._post_gemini(self._gemini_url("generateContent"), payload, prompt, priority)
+        except upstream_scheduler.UpstreamUnavailable as e:
+            return Reply(GEMINI_BUSY_MESSAGE, False, f"Gemini API: 縮退運転中（{str(e)}）")
+        except Exception as e:
+            return Reply(f"エラー: リクエスト送信時に例外が発生しました -> {str(e)}", False, f"Gemini API Exception: {str(e)}")
+        http_ok = response.status_code == 200
+        http_status = "Gemini API: OK" if http_ok else f"Gemini API Error {response.status_code}: {response.text}"
+        try:
+            content_str, reason = _parse_gemini_text(response.json())
+        except Exception as e:
+            return Reply(f"エラー: レスポンス解析に失敗しました -> {str(e)}", False, f"Gemini API 応答解析エラー: {str(e)}")
+        if reason:
+            return Reply(f"回答が見つかりませんでした。({reason})", False, http_status if not http_ok else f"Gemini API Error: {reason}")
+        return Reply(remove_json_artifacts(content_str), http_ok, http_status)
+
+    def call_gemini(self, prompt: str, generation_config: dict = None,
+                    priority: int = upstream_scheduler.PRIORITY_INTERACTIVE,
+                    validate: Optional[Callable[[str], bool]] = None) -> Reply:
+        # 同一プロンプトは応答キャッシュから返し、同時に来た同一リクエストは上流への呼び出しを1回にまとめる
+        # validate(本文) が False の応答はキャッシュしない（成功でも形式が壊れた応答を使い回さない）
+        cache_prompt = prompt if not generation_config else prompt + "\n" + json.dumps(generation_config, sort_keys=True)
+        cache_key = response_cache.ResponseCache.make_key(self.model_name, cache_prompt)
+
+        def fetch():
+            with metrics.timer("gemini_request"):
+                reply = self.request_gemini(prompt, generation_config, priority)
+            if not reply.ok:
+                metrics.incr("errors", upstream="gemini")
+            return tuple(reply), reply.ok and (validate is None or validate(reply.text))
+
+        (text, ok, status), source = response_cache.get_cache().get_or_call(cache_key, fetch)
+        metrics.incr("cache", cache="gemini", result=source)
+        if source == "hit":
+            status = "Gemini API: OK（キャッシュヒット）"
+        elif source == "shared":
+            status += "（同一リクエストを共有）"
+        return Reply(text, ok, status)
+
+    def stream_gemini(self, prompt: str, priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> Iterator[str]:
+        """
+        streamGenerateContent (SSE) を呼び出し、テキストの断片を届いた順に yield する。
+        例外（UpstreamUnavailable を含む）は呼び出し側で処理する。
+        """
+        payload = {"contents": [{"parts": [{"text": prompt}]}]}
+        response = self._post_gemini(self._gemini_url("streamGenerateContent"), payload, prompt, priority, stream=True)
+        with response:
+            if response.status_code != 200:
+                raise RuntimeError(f"Gemini API Error {response.status_code}: {response.text}")
+            # SSE は charset 指定がないことがあるため、バイト列のまま受けて UTF-8 でデコードする
+            for raw_line in response.iter_lines():
+                line = raw_line.decode("utf-8", errors="replace").strip()
+                if not line.startswith("data:"):
+                    continue
+                chunk = json.loads(line[len("data:"):].strip())
+                for candidate in chunk.get("candidates", [])[:1]:
+                    content_val = candidate.get("content", {})
+                    if isinstance(content_val, dict):
+                        text = "".join(p.get("text", "") for p in content_val.get("parts", []))
+                    else:
+                        text = str(content_val)
+                    if text:
+                        yield text
+
+    def stream_persona(self, name: str, prompt: str, priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> Iterator[str]:
+        # 応答キャッシュにあれば全文を1回で返し、なければストリーミングしてからキャッシュに入れる
+        # （同じプロンプトのストリーミングが実行中なら、上流を呼ばずにその断片を共有する）
+        # 最初の断片がこのペルソナの分位点を過ぎても届かなければ、予備のストリーミングを開始し、
+        # 先に断片が届いた方を読む
+        cache = response_cache.get_cache()
+        cache_key = response_cache.ResponseCache.make_key(self.model_name, prompt)
+        label = persona_label(name)
+        policy = persona_latency.get_policy()
+        started = time.perf_counter()
+        try:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                metrics.incr("cache", cache="gemini", result="hit")
+                yield cached[0]
+                return
+            open_stream = lambda: self.stream_gemini(prompt, priority)
+            stream, source = cache.stream(cache_key, open_stream, _stream_reply)
+            metrics.incr("cache", cache="gemini", result=source)
+            policy.record_request()
+            ready = threading.Event()
+            stream.notify_ready(ready)
+            if not ready.wait(policy.hedge_delay(label, persona_latency.FIRST_TOKEN)):
+                stream = self._hedge_stream(stream, cache_key, open_stream, ready)
+            streamed = ""
+            for chunk in stream.read():
+                if not streamed:
+                    first_token = time.perf_counter() - started
+                    metrics.observe("persona_first_token", first_token, persona=label)
+                    if source == "miss":
+                        # 共有した読み手は受信済みの断片をすぐ読めるため、学習に使わない
+                        policy.observe(label, first_token, persona_latency.FIRST_TOKEN)
+                streamed += chunk
+                yield chunk
+            if remove_json_artifacts(streamed):
+                policy.observe(label, time.perf_counter() - started)
+        except Exception:
+            metrics.incr("errors", upstream="gemini")
+            raise
+        finally:
+            metrics.observe("persona", time.perf_counter() - started, persona=label)
+
+    def _hedge_stream(self, primary: response_cache.SharedStream, cache_key: str, open_stream,
+                      ready: threading.Event) -> response_cache.SharedStream:
+        # 予備のストリーミング（他の読み手と共有しない）を開始し、先に断片が届いた方を返す
+        if not upstream_scheduler.get_upstream("gemini").available() or not persona_latency.get_policy().try_hedge():
+            metrics.incr("persona_hedge", result="skipped", mode="stream")
+            return primary
+        metrics.incr("persona_hedge", result="sent", mode="stream")
+        cache = response_cache.get_cache()
+        backup, _ = cache.stream(cache_key, open_stream, _stream_reply, coalesce=False)
+        backup.notify_ready(ready)
+        while True:
+            ready.clear()
+            # 失敗して終わった方は選ばない（両方失敗したら本リクエストのエラーを返す）
+            if primary.succeeded_or_streaming():
+                backup.cancel()
+                metrics.incr("persona_hedge", result="lost", mode="stream")
+                return primary
+            if backup.succeeded_or_streaming():
+                # 遅い本リクエストは既存の読み手のために続けるが、新しい読み手はヘッジ側を共有し、キャッシュもヘッジ側が入れる
+                cache.supersede(cache_key, primary, backup)
+                metrics.incr("persona_hedge", result="won", mode="stream")
+                return backup
+            if primary.done and backup.done:
+                return primary
+            ready.wait()
+
+    def hedge_gemini(self, prompt: str, priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> Reply:
+        # ヘッジ用。応答キャッシュの集約を通すと実行中の本リクエストを待つだけになるため、直接呼び出す
+        with metrics.timer("gemini_request", hedge="yes"):
+            reply = self.request_gemini(prompt, None, priority)
+        if reply.ok:
+            cache_key = response_cache.ResponseCache.make_key(self.model_name, prompt)
+            response_cache.get_cache().put(cache_key, tuple(reply))
+        else:
+            metrics.incr("errors", upstream="gemini")
+        return reply
+
+    # ---- ペルソナの会話 --------------------------------------------------------
+    def iter_discussion(self, agents: Sequence[ChatAgent], question: str, ai_age: int, search_info: str = "",
+                        context: str = "", current_user: str = DEFAULT_USER_NAME,
+                        priority: int = upstream_scheduler.PRIORITY_INTERACTIVE,
+                        deadline: float = persona_latency.TURN_DEADLINE,
+                        late: Optional[Dict[str, Future]] = None) -> Iterator[Tuple[str, Reply]]:
+        """
+        共有イベントループで全ペルソナを同時に呼び出し、完了した順に (名前, 応答) を返す。
+        そのペルソナの所要時間の分位点を過ぎても返らなければヘッジを出し、先に成功した方を使う。
+        deadline 秒（math.inf で無期限）を過ぎたペルソナは PERSONA_LATE_MESSAGE の応答（ok=False）を返し、
+        late が渡されていれば {名前: 応答の Future} を入れる（呼び出しは裏で続き、完了すればキャッシュに入る）。
+        """
+        policy = persona_latency.get_policy()
+        gemini = upstream_scheduler.get_upstream("gemini")
+        started = time.perf_counter()
+        races: Dict[Future, _Race] = {}
+        for agent in agents:
+            race = _Race(agent.name, agent.build_prompt(question, ai_age, search_info, current_user, context), started)
+            race.add(persona_orchestrator.submit(self.call_gemini, race.prompt, None, priority))
+            policy.record_request()
+            races[race.future] = race
+        hedge_at = {race.name: started + policy.hedge_delay(race.label) for race in races.values()}
+        deadline_at = started + deadline
+        pending = set(races)
+        while pending:
+            now = time.perf_counter()
+            if now >= deadline_at:
+                break
+            wake_at = min([deadline_at] + [hedge_at[races[f].name] for f in pending if not races[f].hedged])
+            timeout = None if math.isinf(wake_at) else max(0.0, wake_at - now)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                race = races[future]
+                metrics.observe("persona", time.perf_counter() - started, persona=race.label)
+                if race.hedge_sent:
+                    metrics.incr("persona_hedge", result="won" if race.hedge_won else "lost", mode="parallel")
+                yield race.name, future.result()
+            now = time.perf_counter()
+            for future in pending:
+                race = races[future]
+                if race.hedged or now < hedge_at[race.name]:
+                    continue
+                race.hedged = True
+                if gemini.available() and policy.try_hedge():
+                    metrics.incr("persona_hedge", result="sent", mode="parallel")
+                    race.hedge_sent = True
+                    race.add(persona_orchestrator.submit(self.hedge_gemini, race.prompt, priority), hedge=True)
+                else:
+                    metrics.incr("persona_hedge", result="skipped", mode="parallel")
+        for future in pending:
+            race = races[future]
+            metrics.incr("persona_late", persona=race.label)
+            if late is not None:
+                late[race.name] = future
+            yield race.name, Reply(PERSONA_LATE_MESSAGE, False, f"Gemini API: {deadline:.0f} 秒以内に回答がありませんでした（{race.name}）")
+
+    def discussion_single_call(self, agents: Sequence[ChatAgent], question: str, ai_age: int, search_info: str = "",
+                               context: str = "", current_user: str = DEFAULT_USER_NAME,
+                               priority: int = upstream_scheduler.PRIORITY_INTERACTIVE) -> Tuple[Optional[Dict[str, str]], Reply]:
+        # 1回のリクエストで全員分を生成する。解析できなければ (None, 応答) を返す
+        prompt = build_group_prompt(question, agents, ai_age, search_info, current_user, context)
+        reply = self.call_gemini(
+            prompt, GROUP_RESPONSE_CONFIG, priority,
+            validate=lambda text: parse_group_response(text, agents) is not None,
+        )
+        return parse_group_response(reply.text, agents), reply
+
+    def discussion(self, agents: Sequence[ChatAgent], question: str, ai_age: int, search_info: str = "",
+                   context: str = "", current_user: str = DEFAULT_USER_NAME, single_call: bool = False,
+                   priority: int = upstream_scheduler.PRIORITY_INTERACTIVE,
+                   deadline: float = persona_latency.TURN_DEADLINE) -> Tuple[Dict[str, str], bool, str]:
+        # 全員分の回答を {名前: 回答} で返す（一括生成の解析に失敗したらペルソナごとの呼び出しに戻る）
+        # 戻り値は (回答, 全員成功したか, 最後のステータス)
+        if single_call:
+            responses, reply = self.discussion_single_call(agents, question, ai_age, search_info, context, current_user, priority)
+            if responses is not None:
+                return responses, reply.ok, reply.status
+        replies = dict(self.iter_discussion(agents, question, ai_age, search_info, context, current_user, priority, deadline))
+        responses = {agent.name: replies[agent.name].text for agent in agents}
+        failed = [reply.status for reply in replies.values() if not reply.ok]
+        status = failed[0] if failed else next((reply.status for reply in replies.values()), "")
+        return responses, not failed, status
+
+    def summarize(self, previous_summary: str, new_lines: str, max_chars: int = 300,
+                  priority: int = upstream_scheduler.PRIORITY_BACKGROUND) -> Optional[str]:
+        # conversation_context.build_context の要約の依頼を処理する。失敗したら None（呼び出し側が次のターンでやり直す）
+        # ターンの応答より後回しでよいため、既定の優先度はバックグラウンド
+        # 文字数の指示は少し控えめにする（超えた分は呼び出し側が文末で切る）
+        prompt = (
+            "以下の「これまでの要約」に「新しい会話」の内容を加えて、要約を更新してください。\n"
+            f"誰が何を話したか・話題の流れ・決まったことを残し、{int(max_chars * 0.9)}文字以内の日本語で書いてください。\n\n"
+            f"【これまでの要約】\n{previous_summary or '（なし）'}\n\n"
+            f"【新しい会話】\n{new_lines}\n\n"
+            "更新した要約のみを出力してください。"
+        )
+        reply = self.request_gemini(prompt, priority=priority)
+        return reply.text if reply.ok else None
+
+    # ---- Tavily 検索 -----------------------------------------------------------
+    def fetch_search(self, query: str) -> Tuple[str, bool, str]:
+        # (回答, 成功したか, ステータス) を返す（search_cache.SearchCache.lookup の fetch）
+        url = f"{TAVILY_BASE_URL}/search"
+        headers = {"Authorization": f"Bearer {self.tavily_api_key}", "Content-Type": "application/json"}
+        payload = {
+             "query": query,
+             "topic": "general",
+             "search_depth": "basic",
+             "max_results": 1,
+             "time_range": None,
+             "days": 3,
+             "include_answer": True,
+             "include_raw_content": False,
+             "include_images": False,
+             "include_image_descriptions": False,
+             "include_domains": [],
+             "exclude_domains": []
+        }
+        try:
+             with metrics.timer("search_request"):
+                 response = upstream_scheduler.get_upstream("tavily").call(
+                     lambda: http_client.post(url, headers=headers, json=payload),
+                     is_failure=lambda r: upstream_scheduler.retryable_status(r.status_code),
+                 )
+             if response.status_code != 200:
+                 metrics.incr("errors", upstream="tavily")
+                 return "", False, f"tavily API Error {response.status_code}: {response.text}"
+             data = response.json()
+             return data.get("answer", "") or "", True, "tavily API: OK"
+        except Exception as e:
+             metrics.incr("errors", upstream="tavily")
+             return "", False, f"tavily API Exception: {str(e)}"
+
+    def search(self, query: str) -> search_cache.SearchResult:
+        # TTL + LRU キャッシュ（正規化したクエリがキー、失敗も短時間キャッシュ）
+        result = search_cache.get_cache().lookup(query, self.fetch_search)
+        metrics.incr("cache", cache="search", result=result.cache)
+        return result
+
+    def start_search(self, query: str) -> Tuple[Optional[object], str]:
+        # 検索要否をローカルで判定し、必要なら共有ループ上で検索を開始する。
+        # 戻り値は (Future または None, 省略した場合の理由)
+        decision = search_gate.needs_web_search(query)
+        if not decision.search:
+            return None, f"tavily API: 検索を省略（{decision.reason}）"
+        tavily = upstream_scheduler.get_upstream("tavily")
+        if not tavily.available():
+            # 検索 API が不調の間は検索なしで会話を続ける
+            return None, f"tavily API: 不調のため検索を省略（あと {tavily.breaker.retry_after():.0f} 秒）"
+        return persona_orchestrator.submit(self.search, query), ""
+
+    # ---- 画像解析 --------------------------------------------------------------
+    def analyze_image(self, image_bytes: bytes, augmentations: Sequence[str] = image_analysis.TTA_CONFIG,
+                      image_hash: str = None) -> str:
+        # ディスクキャッシュ（全セッション・プロセス共通）→ 近似重複の索引 → ViT 推論 の順に探す
+        # 上限を超える画像は image_ingest.ImageRejected を送出する
+        augmentations = image_analysis.canonical_tta(augmentations or ())
+        image_hash = image_hash or image_cache.content_hash(image_bytes)
+        scope = image_cache.make_scope(image_analysis.MODEL_TIER, augmentations)
+        cache_key = image_cache.make_key(image_hash, image_analysis.MODEL_TIER, augmentations)
+        analysis_text = _cached_analysis(cache_key)
+        if analysis_text is not None:
+            metrics.incr("cache", cache="image", result="hit")
+            return analysis_text
+
+        # モデル入力に近い大きさまで縮小してから知覚ハッシュを取る（再圧縮・リサイズされた同じ画像を見つける）
+        image = image_ingest.load_image(image_bytes)
+        perceptual_hash = image_dedup.dhash(image)
+        index = image_dedup.get_index()
+        near = index.lookup(perceptual_hash, scope, _cached_analysis)
+        if near is not None:
+            metrics.incr("cache", cache="image", result="near-hit")
+            analysis_text = near[1]
+        else:
+            metrics.incr("cache", cache="image", result="miss")
+            # 推論ワーカーで他のセッションの画像とまとめて推論
+            analysis_text = vit_worker.get_worker().submit(image, augmentations).result()
+        try:
+            image_cache.get_cache().put(cache_key, analysis_text, scope, perceptual_hash)
+        except (sqlite3.Error, OSError):
+            pass
+        index.add(perceptual_hash, scope, cache_key)
+        return analysis_text
+
+
+def _cached_analysis(cache_key: str) -> Optional[str]:
+    try:
+        return image_cache.get_cache().get(cache_key)
+    except (sqlite3.Error, OSError):
+        # 保存先を作れない・開けない場合はキャッシュなしで解析する
+        return None
@@ -0,0 +1,35 @@
+# =============================================================================
+# チャット吹き出しの HTML 生成と履歴の表示範囲
+#   - 表示する履歴は最新 N 件のウィンドウ／ページ単位に絞る
+#     （再実行ごとの描画コストは表示件数で決まるため、HTML 断片はキャッシュしない）
+# =============================================================================
+from typing import Sequence, Tuple
+
+HISTORY_WINDOW = 20  # チャット欄に最初に表示する最新メッセージ数
+HISTORY_PAGE_SIZE = 20  # 「会話履歴」1ページあたりの件数
+
+
+def bubble_html(display_name: str, content: str, align: str = "left") -> str:
+    return (
+        f'<div style="text-align: {align};">'
+        f'<div class="chat-bubble">'
+        f'<div class="chat-header">{display_name}</div>{content}'
+        f'</div></div>'
+    )
+
+
+def window(messages: Sequence, size: int) -> Tuple[int, Sequence]:
+    # 最新 size 件を返す。戻り値は (表示しない古いメッセージの件数, 表示するメッセージ)
+    start = max(0, len(messages) - size)
+    return start, messages[start:]
+
+
+def page_count(total: int, page_size: int = HISTORY_PAGE_SIZE) -> int:
+    return max(1, -(-total // page_size))
+
+
+def newest_first_page(messages: Sequence, page: int, page_size: int = HISTORY_PAGE_SIZE) -> Sequence:
+    # 新しい順に並べたときの page ページ目（1始まり）を、新しい順で返す
+    end = len(messages) - (page - 1) * page_size
+    start = max(0, end - page_size)
+    return list(reversed(messages[start:max(0, end)]))
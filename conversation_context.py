@@ -0,0 +1,120 @@
+# =============================================================================
+# トークン予算つきの会話コンテキスト
+#   - 直近の発言は予算内でそのまま渡す
+#   - 予算からあふれた古い発言は「これまでの要約」に少しずつ畳み込む
+#     （各発言は1回だけ要約され、要約済みの発言を再要約しない。要約に失敗したら次のターンでやり直す）
+#   - 要約はターンを待たせないよう呼び出し側がバックグラウンドで行い、次のターンで apply_summary で反映する
+#     要約が済むまでは、あふれた発言（要約待ち）もそのままコンテキストに入れる
+#   - 要約待ちの発言は CONTEXT_SUMMARY_BACKLOG_TOKENS までに抑える（要約の失敗が続いても増え続けない）
+#   - 状態（要約と要約済みの位置）は呼び出し側が保存する（Streamlit では session_state）
+#   - 要約済みの発言は使わないため、呼び出し側は offset 以降の発言だけを渡してよい
+# =============================================================================
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1200"))
+# 予算のうち要約に割り当てる割合（残りを直近の発言に使う）
+SUMMARY_SHARE = 1 / 3
+# 要約待ちの発言の上限（超えた分は古い方から要約せずに捨てる）
+SUMMARY_BACKLOG_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_BACKLOG_TOKENS", "4000"))
+
+
+def estimate_tokens(text: str) -> int:
+    # 目安: ASCII は約4文字で1トークン、日本語などはおよそ1文字1トークン
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def new_state() -> Dict:
+    return {"summary": "", "summarized_upto": 0}
+
+
+def format_lines(messages: Sequence[Tuple[str, str]]) -> List[str]:
+    return [f"{role}: {content}" for role, content in messages]
+
+
+def fit_summary(text: str, max_chars: int) -> str:
+    # 1文字は1トークン以下と見積もっているため、文字数で収めれば要約の予算を超えない。
+    # 文の途中では切らない（収まらなければ予算内の最後の文末まで）
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    end = max(cut.rfind(mark) for mark in "。！？!?\n")
+    return cut[:end + 1].rstrip() if end > 0 else cut
+
+
+def build_context(
+    messages: Sequence[Tuple[str, str]],
+    state: Dict,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    offset: int = 0,
+) -> Tuple[str, Dict, Optional[Dict]]:
+    """
+    messages は古い順の (話者, 内容) で、会話全体の offset 件目以降。
+    戻り値は (プロンプトに入れるコンテキスト文字列, 更新後の状態, 要約の依頼)。
+    要約の依頼（予算からあふれた発言がなければ None）は呼び出し側が
+    summarize(依頼["summary"], 依頼["lines"], 依頼["max_chars"]) で要約し、apply_summary で状態に反映する。
+    """
+    state = dict(state or new_state())
+    # 要約済み位置が履歴より先にある場合（履歴がリセットされた等）は状態を作り直す
+    if state["summarized_upto"] > offset + len(messages):
+        state = new_state()
+    # offset より前の発言は渡されていないため、要約済みとして扱う
+    summarized_upto = max(state["summarized_upto"], offset)
+    lines = format_lines(messages[summarized_upto - offset:])
+
+    # 新しい方から予算内に収まるところまでを「直近の発言」とする
+    summary_budget = int(budget * SUMMARY_SHARE)
+    remaining = budget - summary_budget
+    recent_start = len(lines)
+    while recent_start > 0:
+        cost = estimate_tokens(lines[recent_start - 1])
+        if cost > remaining:
+            break
+        remaining -= cost
+        recent_start -= 1
+
+    # 予算からあふれた未要約の発言が要約待ち。上限を超えた分は古い方から捨てる（要約済みとして進める）
+    backlog_start = 0
+    backlog_tokens = sum(estimate_tokens(line) for line in lines[:recent_start])
+    while backlog_tokens > SUMMARY_BACKLOG_TOKENS and backlog_start < recent_start:
+        backlog_tokens -= estimate_tokens(lines[backlog_start])
+        backlog_start += 1
+    summarized_upto += backlog_start
+    state["summarized_upto"] = summarized_upto
+    backlog = lines[backlog_start:recent_start]
+
+    request = None
+    if backlog:
+        request = {
+            "summary": state["summary"],
+            "lines": "\n".join(backlog),
+            "max_chars": summary_budget,
+            "base_upto": summarized_upto,
+            "upto": summarized_upto + len(backlog),
+        }
+
+    parts = []
+    if state["summary"]:
+        parts.append(f"（これまでの会話の要約）\n{state['summary']}")
+    # 要約に畳み込まれるまでは、要約待ちの発言を新しい方から要約の予算の範囲でそのまま入れる
+    pending_start = len(backlog)
+    remaining = summary_budget
+    while pending_start > 0 and estimate_tokens(backlog[pending_start - 1]) <= remaining:
+        remaining -= estimate_tokens(backlog[pending_start - 1])
+        pending_start -= 1
+    if pending_start < len(backlog):
+        parts.append("（要約前の会話）\n" + "\n".join(backlog[pending_start:]))
+    if recent_start < len(lines):
+        parts.append("（直近の会話）\n" + "\n".join(lines[recent_start:]))
+    return "\n".join(parts), state, request
+
+
+def apply_summary(state: Dict, request: Dict, summary: Optional[str]) -> Dict:
+    """build_context の要約の依頼の結果を状態に反映する。失敗（None）や、依頼後に状態が変わっていたら反映しない。"""
+    state = dict(state or new_state())
+    if summary is None or (state["summary"], state["summarized_upto"]) != (request["summary"], request["base_upto"]):
+        return state
+    state["summary"] = fit_summary(summary, request["max_chars"])
+    state["summarized_upto"] = request["upto"]
+    return state
@@ -0,0 +1,240 @@
+# =============================================================================
+# 会話ログの保存（セッションごと）
+#   - 1件は __slots__ の小さなレコード（話者名は intern して全セッションで共有）
+#   - メモリには直近 CONVERSATION_MEMORY_WINDOW 件だけを持ち、全件は SQLite に追記する
+#     （古い発言は履歴の表示などで必要になったときに DB から読む）
+#   - セッション ID ごとに保存するため、プロセスの再起動後も同じ ID で会話を再開できる
+#   - 要約の状態などセッションの小さな状態（meta）も JSON で保存する
+#   - 最終更新から CONVERSATION_MAX_AGE_DAYS 日を過ぎたセッションは削除する
+#     （セッションを開くときに、前回の削除から CONVERSATION_PURGE_INTERVAL_HOURS 時間を過ぎていれば）
+#   - 同じセッション ID を複数のタブで開いても発言を上書きしないよう、連番は DB 側で採番する
+# =============================================================================
+import itertools
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from collections.abc import Sequence
+from typing import Dict, List, Optional
+
+DEFAULT_PATH = os.environ.get(
+    "CONVERSATION_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "conversations.sqlite3"),
+)
+MEMORY_WINDOW = int(os.environ.get("CONVERSATION_MEMORY_WINDOW", "50"))
+MAX_AGE_SECONDS = float(os.environ.get("CONVERSATION_MAX_AGE_DAYS", "30")) * 24 * 3600
+PURGE_INTERVAL_SECONDS = float(os.environ.get("CONVERSATION_PURGE_INTERVAL_HOURS", "6")) * 3600
+
+_SESSION_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id: str) -> bool:
+    return bool(session_id) and _SESSION_ID.fullmatch(session_id) is not None
+
+
+class Message:
+    __slots__ = ("seq", "role", "content")
+
+    def __init__(self, seq: int, role: str, content: str):
+        self.seq = seq
+        self.role = sys.intern(role)
+        self.content = content
+
+    def __repr__(self) -> str:
+        return f"Message({self.seq}, {self.role!r}, {self.content[:20]!r})"
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=5)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _init_db(path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL,"
+            " created REAL NOT NULL, PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY, meta TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions(updated)")
+
+
+def purge_expired(path: str = DEFAULT_PATH, max_age: float = MAX_AGE_SECONDS) -> int:
+    cutoff = time.time() - max_age
+    with _connect(path) as conn:
+        expired = [row[0] for row in conn.execute("SELECT session_id FROM sessions WHERE updated < ?", (cutoff,))]
+        for session_id in expired:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+    return len(expired)
+
+
+class ConversationStore(Sequence):
+    """
+    1セッションの会話ログ。古い順の Message の列として読める（len・添字・スライス）。
+    直近 window 件より前を読むときだけ DB に問い合わせる。
+    """
+
+    def __init__(self, session_id: str, path: str = DEFAULT_PATH, window: int = MEMORY_WINDOW):
+        self.session_id = session_id
+        self.path = path
+        self._recent = deque(maxlen=max(1, window))
+        self._count = 0
+        self._lock = threading.Lock()
+        self.meta: Dict = {}
+        self.persistent = True
+        try:
+            _init_db(path)
+            self._load()
+        except (sqlite3.Error, OSError):
+            # DB が使えない（保存先を作れない・書き込めない・壊れている）場合はメモリだけで保持する（上限なし、再起動後は再開できない）
+            self.persistent = False
+            self._recent = deque()
+
+    def _load(self) -> None:
+        # 再開時は件数・meta と直近 window 件だけを読む
+        with _connect(self.path) as conn:
+            (count,) = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session_id = ?", (self.session_id,)
+            ).fetchone()
+            rows = conn.execute(
+                "SELECT seq, role, content FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                (self.session_id, count - self._recent.maxlen),
+            ).fetchall()
+            meta_row = conn.execute("SELECT meta FROM sessions WHERE session_id = ?", (self.session_id,)).fetchone()
+        self._count = count
+        self._recent.extend(Message(seq, role, content) for seq, role, content in rows)
+        self.meta = json.loads(meta_row[0]) if meta_row else {}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._range(start, stop)
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("conversation index out of range")
+        return self._range(index, index + 1)[0]
+
+    def in_memory(self) -> int:
+        return len(self._recent)
+
+    def _range(self, start: int, stop: int) -> List[Message]:
+        if start >= stop:
+            return []
+        with self._lock:
+            memory_start = self._count - len(self._recent)
+            recent = list(itertools.islice(self._recent, max(0, start - memory_start), max(0, stop - memory_start)))
+        older = self._fetch(start, min(stop, memory_start)) if start < memory_start else []
+        return older + recent
+
+    def _fetch(self, start: int, stop: int) -> List[Message]:
+        try:
+            with _connect(self.path) as conn:
+                rows = conn.execute(
+                    "SELECT seq, role, content FROM messages WHERE session_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                    (self.session_id, start, stop),
+                ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [Message(seq, role, content) for seq, role, content in rows]
+
+    def append(self, role: str, content: str) -> Message:
+        with self._lock:
+            if self.persistent:
+                try:
+                    with _connect(self.path) as conn:
+                        # 連番は DB 側で採番する（同じセッションを別のタブで開いていても上書きしない）
+                        conn.execute("BEGIN IMMEDIATE")
+                        conn.execute(
+                            "INSERT INTO messages"
+                            " SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ? FROM messages WHERE session_id = ?",
+                            (self.session_id, role, content, time.time(), self.session_id),
+                        )
+                        (seq,) = conn.execute(
+                            "SELECT MAX(seq) FROM messages WHERE session_id = ?", (self.session_id,)
+                        ).fetchone()
+                        self._touch(conn)
+                        if seq != self._count:
+                            # 別のタブが書き込んでいた: 直近の発言を DB から読み直す
+                            self._resync(conn, seq)
+                            return self._recent[-1]
+                except sqlite3.Error:
+                    # 以降はメモリだけで保持する（書き込めた分より前は DB から読めるうちは読む）
+                    self.persistent = False
+                    self._recent = deque(self._recent)
+            message = Message(self._count, role, content)
+            self._recent.append(message)
+            self._count += 1
+        return message
+
+    def _resync(self, conn: sqlite3.Connection, last_seq: int) -> None:
+        rows = conn.execute(
+            "SELECT seq, role, content FROM messages WHERE session_id = ? AND seq > ? ORDER BY seq",
+            (self.session_id, last_seq - self._recent.maxlen),
+        ).fetchall()
+        self._recent.clear()
+        self._recent.extend(Message(seq, role, content) for seq, role, content in rows)
+        self._count = last_seq + 1
+
+    def save_meta(self, meta: Dict) -> None:
+        self.meta = dict(meta)
+        if not self.persistent:
+            return
+        try:
+            with _connect(self.path) as conn:
+                self._touch(conn)
+        except sqlite3.Error:
+            pass
+
+    def _touch(self, conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+            (self.session_id, json.dumps(self.meta, ensure_ascii=False), time.time()),
+        )
+
+
+_last_purge: Optional[float] = None
+_purge_lock = threading.Lock()
+
+
+def _purge_due() -> bool:
+    return _last_purge is None or time.monotonic() - _last_purge >= PURGE_INTERVAL_SECONDS
+
+
+def open_session(session_id: Optional[str] = None, path: str = DEFAULT_PATH) -> ConversationStore:
+    # 不正な ID なら新しい会話にする。期限切れのセッションの削除は PURGE_INTERVAL_SECONDS ごと
+    global _last_purge
+    if _purge_due():
+        with _purge_lock:
+            if _purge_due():
+                _last_purge = time.monotonic()
+                try:
+                    _init_db(path)
+                    purge_expired(path)
+                except (sqlite3.Error, OSError):
+                    pass
+    if not is_valid_session_id(session_id or ""):
+        session_id = new_session_id()
+    return ConversationStore(session_id, path)
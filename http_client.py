@@ -0,0 +1,167 @@
+# =============================================================================
+# 共有HTTPクライアント層
+#   - プロセス全体で1つの requests.Session を共有し、ホストごとのコネクションプールで
+#     keep-alive 接続を再利用する（毎回の TCP+TLS ハンドシェイクを避ける）
+#   - 接続／読み取りタイムアウトを必ず指定する（ソケット停止でスクリプトスレッドが固まらない）
+#   - 429 / 5xx と接続エラーはジッター付き指数バックオフで再試行する
+#   - 新規接続数・再利用数などのカウンタを保持する
+# =============================================================================
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# ペルソナ4人分の同時呼び出し × 複数セッションを想定したプールサイズ
+POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "16"))
+# 接続先ホスト数（Gemini / Tavily + 予備）
+POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "4"))
+# (接続タイムアウト, 読み取りタイムアウト) 秒
+DEFAULT_TIMEOUT: Tuple[float, float] = (
+    float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5")),
+    float(os.environ.get("HTTP_READ_TIMEOUT", "60")),
+)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    retry_statuses: frozenset = field(default_factory=lambda: frozenset({429, 500, 502, 503, 504}))
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # Full Jitter: [0, min(上限, base * 2^attempt)] の一様乱数
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+
+DEFAULT_RETRY = RetryPolicy()
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": max(0, self.requests - self.new_connections),
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+            }
+
+
+_stats = _Stats()
+
+
+# 新規接続の生成回数を数えるためのプールクラス
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _stats.incr("new_connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _stats.incr("new_connections")
+        return super()._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = _PooledAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def request(method: str, url: str, *, timeout=None, retry: Optional[RetryPolicy] = None, **kwargs) -> requests.Response:
+    """
+    共有セッション経由でリクエストを送信する。
+    再試行対象のステータスは再試行し、最終的なレスポンスをそのまま返す（ステータス判定は呼び出し側）。
+    例外は再試行を使い切った時点で送出する。
+    """
+    timeout = timeout or DEFAULT_TIMEOUT
+    retry = retry or DEFAULT_RETRY
+    session = get_session()
+    attempt = 0
+    while True:
+        _stats.incr("requests")
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if isinstance(e, requests.Timeout):
+                _stats.incr("timeouts")
+            if attempt >= retry.max_retries:
+                _stats.incr("errors")
+                raise
+            time.sleep(retry.backoff(attempt))
+            attempt += 1
+            _stats.incr("retries")
+            continue
+        if response.status_code in retry.retry_statuses and attempt < retry.max_retries:
+            delay = retry.backoff(attempt, _retry_after_seconds(response))
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+            _stats.incr("retries")
+            continue
+        if response.status_code >= 400:
+            _stats.incr("errors")
+        return response
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def get_stats() -> dict:
+    return _stats.snapshot()
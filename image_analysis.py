@@ -0,0 +1,149 @@
+# =============================================================================
+# 画像解析（ViT）: モデル階層とバッチ化したテスト時拡張（TTA）
+#   - モデル階層（ViT-Large fp32 / ViT-Large 動的int8量子化 / ViT-Base / ViT-Small）を
+#     環境変数 VIT_MODEL_TIER で選択する（精度と速度の比較は benchmarks/vit_tiers.py）
+#   - torch / transformers の import とモデル読み込みは初回利用時まで遅延する
+#     （環境変数 VIT_WARMUP=1 で起動時にバックグラウンドで先読み）
+#   - 拡張ビューをまとめて前処理し、1つのテンソルにして1回の順伝播で推論する
+#     （複数セッションの画像をまとめる推論ワーカーは vit_worker.py）
+#   - 拡張の組み合わせは設定可能（環境変数 VIT_TTA、"none" で TTA 無効）
+# =============================================================================
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from PIL import Image
+
+import metrics
+
+# 階層名 → (モデル名, 動的int8量子化の有無)
+MODEL_TIERS: Dict[str, Tuple[str, bool]] = {
+    "large": ("google/vit-large-patch16-224", False),
+    "large-int8": ("google/vit-large-patch16-224", True),
+    "base": ("google/vit-base-patch16-224", False),
+    "small": ("WinKawaks/vit-small-patch16-224", False),
+}
+BASELINE_TIER = "large"
+MODEL_TIER = os.environ.get("VIT_MODEL_TIER", BASELINE_TIER)
+
+
+def load_model(tier: str = MODEL_TIER):
+    if tier not in MODEL_TIERS:
+        raise ValueError(f"未知のモデル階層です: {tier}（{', '.join(MODEL_TIERS)}）")
+    import torch
+    from transformers import AutoFeatureExtractor, ViTForImageClassification
+    model_name, quantize = MODEL_TIERS[tier]
+    extractor = AutoFeatureExtractor.from_pretrained(model_name)
+    model = ViTForImageClassification.from_pretrained(model_name)
+    model.eval()
+    if quantize:
+        # Linear 層の重みを int8 に動的量子化（CPU 推論向け）
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return extractor, model
+
+
+_models: Dict[str, tuple] = {}
+_model_lock = threading.Lock()
+_warmup_thread = None
+
+
+def get_model(tier: str = MODEL_TIER):
+    # プロセス内で1回だけ読み込む（同時に呼ばれても読み込みは1回）
+    if tier not in _models:
+        with _model_lock:
+            if tier not in _models:
+                _models[tier] = load_model(tier)
+    return _models[tier]
+
+
+def is_model_loaded(tier: str = MODEL_TIER) -> bool:
+    return tier in _models
+
+
+def start_warmup(tier: str = MODEL_TIER) -> None:
+    # 画像が来る前にバックグラウンドでモデルを読み込んでおく（何度呼んでも1回だけ）
+    global _warmup_thread
+    with _model_lock:
+        if _warmup_thread is not None or tier in _models:
+            return
+        _warmup_thread = threading.Thread(target=get_model, args=(tier,), name="vit-warmup", daemon=True)
+    _warmup_thread.start()
+
+
+# 拡張名 → PIL 画像の変換
+TTA_AUGMENTATIONS: Dict[str, Callable[[Image.Image], Image.Image]] = {
+    "identity": lambda img: img,
+    "hflip": lambda img: img.transpose(Image.FLIP_LEFT_RIGHT),
+    "rotate15": lambda img: img.rotate(15),
+}
+DEFAULT_TTA: Tuple[str, ...] = ("identity", "hflip", "rotate15")
+TOP_K = 3
+
+
+def parse_tta(spec: str) -> Tuple[str, ...]:
+    # "identity,hflip" のようなカンマ区切り。"none" / "off" / 空なら TTA なし（元画像のみ）
+    spec = (spec or "").strip().lower()
+    if spec in ("", "none", "off", "0", "false"):
+        return ("identity",)
+    names = tuple(name.strip() for name in spec.split(",") if name.strip())
+    unknown = [name for name in names if name not in TTA_AUGMENTATIONS]
+    if unknown:
+        raise ValueError(f"未知のTTA拡張です: {', '.join(unknown)}")
+    return canonical_tta(names)
+
+
+def canonical_tta(names: Iterable[str]) -> Tuple[str, ...]:
+    # 結果は拡張の順序によらないため、TTA_AUGMENTATIONS の順に並べる（キャッシュのキー・索引の単位を揃える）
+    selected = set(names)
+    return tuple(name for name in TTA_AUGMENTATIONS if name in selected) or ("identity",)
+
+
+TTA_CONFIG: Tuple[str, ...] = parse_tta(os.environ.get("VIT_TTA", ",".join(DEFAULT_TTA)))
+WARMUP = os.environ.get("VIT_WARMUP", "0").lower() in ("1", "true", "yes")
+
+
+def build_views(pil_image: Image.Image, augmentations: Iterable[str] = TTA_CONFIG) -> List[Image.Image]:
+    if pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
+    return [TTA_AUGMENTATIONS[name](pil_image) for name in augmentations] or [pil_image]
+
+
+def format_topk(avg_logits, id2label: dict, k: int = TOP_K) -> str:
+    # avg_logits: 形状 (num_labels,) のテンソル
+    import torch
+    probs = torch.nn.functional.softmax(avg_logits, dim=-1)
+    top_indices = avg_logits.topk(k).indices.tolist()
+    result_str = []
+    for idx in top_indices:
+        label_name = id2label[idx]
+        confidence = probs[idx].item()
+        result_str.append(f"{label_name} ({confidence*100:.1f}%)")
+    return ", ".join(result_str)
+
+
+def predict_logits_batch(requests: Sequence[Tuple[Image.Image, Iterable[str]]], extractor, model) -> list:
+    """
+    複数の画像（それぞれ TTA の拡張を指定）の全ビューを1バッチに前処理して1回の順伝播で推論し、
+    画像ごとにビューの平均ロジットを返す。
+    """
+    import torch
+    with metrics.timer("vit_preprocess"):
+        views_per_image = [build_views(pil_image, augmentations) for pil_image, augmentations in requests]
+        inputs = extractor([view for views in views_per_image for view in views], return_tensors="pt")
+    with metrics.timer("vit_inference"), torch.inference_mode():
+        logits = model(**inputs).logits
+    results = []
+    start = 0
+    for views in views_per_image:
+        results.append(logits[start:start + len(views)].mean(dim=0))
+        start += len(views)
+    return results
+
+
+def predict_logits(pil_image: Image.Image, extractor, model, augmentations: Iterable[str] = TTA_CONFIG):
+    return predict_logits_batch([(pil_image, augmentations)], extractor, model)[0]
+
+
+def classify(pil_image: Image.Image, extractor, model, augmentations: Iterable[str] = TTA_CONFIG) -> str:
+    avg_logits = predict_logits(pil_image, extractor, model, augmentations)
+    return format_topk(avg_logits, model.config.id2label)
@@ -0,0 +1,159 @@
+# =============================================================================
+# 画像解析結果のディスクキャッシュ（SQLite）
+#   - 画像の内容ハッシュ（SHA-256）＋モデル階層＋TTA 設定をキーにする
+#   - セッション・プロセス・再起動をまたいで共有される
+#   - 保存期間と件数／合計サイズの上限で古いもの（最終参照が古い順）から削除する
+#   - ヒット／ミス数を DB に記録する（全プロセス合算）
+#   - 近似重複の索引（image_dedup）用に、結果ごとの知覚ハッシュも保存する
+# =============================================================================
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+DEFAULT_PATH = os.environ.get(
+    "IMAGE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "image_analysis.sqlite3"),
+)
+MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "10000"))
+MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+MAX_AGE_SECONDS = float(os.environ.get("IMAGE_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+# 書き込み何回ごとに削除処理を走らせるか
+EVICT_EVERY = 50
+
+
+def content_hash(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def make_scope(tier: str, augmentations: Iterable[str]) -> str:
+    # 同じ画像でも結果が変わる設定（モデル階層・TTA）
+    return f"{tier}:{','.join(augmentations)}"
+
+
+def make_key(digest: str, tier: str, augmentations: Iterable[str]) -> str:
+    return f"{digest}:{make_scope(tier, augmentations)}"
+
+
+class ImageAnalysisCache:
+    def __init__(self, path: str = DEFAULT_PATH, max_entries: int = MAX_ENTRIES,
+                 max_bytes: int = MAX_BYTES, max_age: float = MAX_AGE_SECONDS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analysis ("
+                " key TEXT PRIMARY KEY, result TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS analysis_last_access ON analysis(last_access)")
+            # 知覚ハッシュは 64 ビット符号なしのため、16進文字列で持つ
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS perceptual_hash ("
+                " key TEXT PRIMARY KEY, scope TEXT NOT NULL, hash TEXT NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッドごとに持つ（WAL で複数プロセスからの読み書きに対応）
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _incr(self, conn: sqlite3.Connection, name: str, value: int = 1) -> None:
+        conn.execute("UPDATE stats SET value = value + ? WHERE name = ?", (value, name))
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT result FROM analysis WHERE key = ? AND created >= ?", (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self._incr(conn, "misses")
+                return None
+            conn.execute("UPDATE analysis SET last_access = ? WHERE key = ?", (now, key))
+            self._incr(conn, "hits")
+            return row[0]
+
+    def put(self, key: str, result: str, scope: str = None, perceptual_hash: int = None) -> None:
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                (key, result, len(result.encode("utf-8")), now, now),
+            )
+            if scope is not None and perceptual_hash is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO perceptual_hash VALUES (?, ?, ?)", (key, scope, f"{perceptual_hash:016x}")
+                )
+        with self._lock:
+            self._writes += 1
+            run_evict = self._writes % EVICT_EVERY == 1
+        if run_evict:
+            self.evict()
+
+    def evict(self) -> int:
+        now = time.time()
+        with self._conn() as conn:
+            removed = conn.execute("DELETE FROM analysis WHERE created < ?", (now - self.max_age,)).rowcount
+            count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis").fetchone()
+            # 件数・サイズの上限を超えた分を、最終参照が古い順に削除する
+            while count > self.max_entries or total > self.max_bytes:
+                batch = max(1, count - self.max_entries, count // 10)
+                removed_rows = conn.execute(
+                    "DELETE FROM analysis WHERE key IN ("
+                    " SELECT key FROM analysis ORDER BY last_access ASC LIMIT ?)", (batch,)
+                ).rowcount
+                if not removed_rows:
+                    break
+                removed += removed_rows
+                count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis").fetchone()
+            if removed:
+                self._incr(conn, "evictions", removed)
+                conn.execute("DELETE FROM perceptual_hash WHERE key NOT IN (SELECT key FROM analysis)")
+        return removed
+
+    def perceptual_hashes(self, limit: int) -> List[Tuple[str, str, int]]:
+        # 最近参照された limit 件の (キー, scope, ハッシュ) を古い順に返す
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT p.key, p.scope, p.hash FROM perceptual_hash p JOIN analysis a ON a.key = p.key"
+                " WHERE a.created >= ? ORDER BY a.last_access DESC LIMIT ?",
+                (time.time() - self.max_age, limit),
+            ).fetchall()
+        return [(key, scope, int(value, 16)) for key, scope, value in reversed(rows)]
+
+    def stats(self) -> dict:
+        with self._conn() as conn:
+            result = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+            result["entries"], result["bytes"] = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis"
+            ).fetchone()
+        return result
+
+
+_default_cache: Optional[ImageAnalysisCache] = None
+_default_lock = threading.Lock()
+
+
+def get_cache() -> ImageAnalysisCache:
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = ImageAnalysisCache()
+    return _default_cache
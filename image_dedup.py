@@ -0,0 +1,178 @@
+# =============================================================================
+# 近似重複画像の索引（知覚ハッシュ dHash ＋ BK 木）
+#   - 保存し直し・再圧縮・軽いリサイズなどでバイト列が変わった同じ画像を見つけ、
+#     保存済みの解析結果を使い回す（ViT の推論を省く）
+#   - dHash（64 ビット）のハミング距離が IMAGE_DHASH_THRESHOLD 以下なら同じ画像とみなす
+#   - 索引はモデル階層＋TTA 設定（image_cache.make_scope）ごとに分ける
+#   - 起動時に画像解析キャッシュ（SQLite）から読み込み、以降はプロセス内で更新する
+# =============================================================================
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+import image_cache
+
+THRESHOLD = int(os.environ.get("IMAGE_DHASH_THRESHOLD", "6"))
+MAX_ENTRIES = int(os.environ.get("IMAGE_DHASH_MAX_ENTRIES", "10000"))
+HASH_SIZE = 8  # 8x8 = 64 ビット
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    # 縮小したグレースケール画像で、横に隣り合う画素の明暗の並びをビットにする
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """ハミング距離の BK 木。ノードは [ハッシュ, 値, {距離: 子ノード}]。"""
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value_hash: int, value) -> None:
+        if self._root is None:
+            self._root = [value_hash, value, {}]
+            self._size = 1
+            return
+        node = self._root
+        while True:
+            distance = hamming(value_hash, node[0])
+            if distance == 0:
+                node[1] = value
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value_hash, value, {}]
+                self._size += 1
+                return
+            node = child
+
+    def nearest(self, value_hash: int, threshold: int) -> Optional[Tuple[int, int, object]]:
+        # 距離 threshold 以内で最も近い (距離, 登録済みのハッシュ, 値)。三角不等式で調べる枝を絞る
+        if self._root is None:
+            return None
+        best = None
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value_hash, node[0])
+            if distance <= threshold and (best is None or distance < best[0]):
+                best = (distance, node[0], node[1])
+                if distance == 0:
+                    break
+            for child_distance, child in node[2].items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    stack.append(child)
+        return best
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold: int = THRESHOLD, max_entries: int = MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # scope -> OrderedDict(ハッシュ -> キャッシュキー)（古い順）。木は必要になったときに作り直す
+        self._entries: Dict[str, "OrderedDict[int, str]"] = {}
+        self._trees: Dict[str, BKTree] = {}
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+        self._distances: Dict[int, int] = {}
+
+    def _tree(self, scope: str) -> BKTree:
+        tree = self._trees.get(scope)
+        if tree is None:
+            tree = self._trees[scope] = BKTree()
+            for value_hash, key in self._entries.get(scope, {}).items():
+                tree.add(value_hash, key)
+        return tree
+
+    def add(self, value_hash: int, scope: str, key: str) -> None:
+        with self._lock:
+            entries = self._entries.setdefault(scope, OrderedDict())
+            entries[value_hash] = key
+            entries.move_to_end(value_hash)
+            if len(entries) > self.max_entries:
+                # 古いものから1割まとめて捨てて木を作り直す（1件ずつ作り直さない）
+                for _ in range(max(1, self.max_entries // 10)):
+                    entries.popitem(last=False)
+                self._trees.pop(scope, None)
+            elif scope in self._trees:
+                self._trees[scope].add(value_hash, key)
+
+    def remove(self, value_hash: int, scope: str) -> None:
+        # 解析結果がキャッシュから消えていた場合などに呼ぶ
+        with self._lock:
+            if self._entries.get(scope, {}).pop(value_hash, None) is not None:
+                self._trees.pop(scope, None)
+
+    def lookup(self, value_hash: int, scope: str, resolve: Callable[[str], Optional[str]]) -> Optional[Tuple[int, str]]:
+        """
+        閾値内で最も近い登録済み画像を探し、resolve(キャッシュキー) で解析結果を取り出す。
+        戻り値は (距離, 解析結果)。見つからない、または結果がキャッシュから消えていれば None。
+        """
+        with self._lock:
+            self._lookups += 1
+            found = self._tree(scope).nearest(value_hash, self.threshold)
+        if found is None:
+            return None
+        distance, found_hash, key = found
+        result = resolve(key)  # DB の読み込みはロックの外で行う
+        if result is None:
+            self.remove(found_hash, scope)
+            return None
+        with self._lock:
+            self._hits += 1
+            self._distances[distance] = self._distances.get(distance, 0) + 1
+        return distance, result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "entries": sum(len(entries) for entries in self._entries.values()),
+                "distances": dict(sorted(self._distances.items())),
+                "threshold": self.threshold,
+            }
+
+
+_default_index: Optional[NearDuplicateIndex] = None
+_default_lock = threading.Lock()
+
+
+def load_from_cache(index: NearDuplicateIndex, cache: image_cache.ImageAnalysisCache) -> None:
+    rows: List[Tuple[str, str, int]] = cache.perceptual_hashes(limit=index.max_entries)
+    for key, scope, value_hash in rows:
+        index.add(value_hash, scope, key)
+
+
+def get_index() -> NearDuplicateIndex:
+    global _default_index
+    if _default_index is None:
+        with _default_lock:
+            if _default_index is None:
+                index = NearDuplicateIndex()
+                try:
+                    load_from_cache(index, image_cache.get_cache())
+                except (sqlite3.Error, OSError):
+                    pass  # キャッシュが使えなくても、このプロセス内の索引として動く
+                _default_index = index
+    return _default_index
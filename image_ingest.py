@@ -0,0 +1,59 @@
+# =============================================================================
+# 画像の取り込み（メモリ上限つき）
+#   - バイト数・画素数の上限を、画素をデコードする前（ヘッダーの段階）で確認する
+#   - JPEG はドラフトモードで縮小デコードする（DCT の段階で 1/2〜1/8 に落とす）
+#   - モデル入力に近い大きさ（長辺 INGEST_MAX_SIDE）まで先に縮小してから、
+#     EXIF の向きを反映して RGB にする（TTA の拡張はこの小さな画像から作る）
+#   上限は環境変数 IMAGE_MAX_BYTES / IMAGE_MAX_PIXELS / IMAGE_INGEST_SIDE で変更できる。
+# =============================================================================
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+import metrics
+
+MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", str(50_000_000)))
+# ViT の入力は 224x224。縮小時の折り返しを抑えるため、少し余裕をもたせる
+INGEST_MAX_SIDE = int(os.environ.get("IMAGE_INGEST_SIDE", "448"))
+
+
+class ImageRejected(ValueError):
+    """上限を超えた、または画像として読めない。"""
+
+
+def check_bytes(size: int) -> None:
+    if size > MAX_BYTES:
+        raise ImageRejected(f"画像が大きすぎます（{size / 1024 / 1024:.1f} MB、上限 {MAX_BYTES / 1024 / 1024:.0f} MB）")
+
+
+def load_image(data: bytes, max_side: int = INGEST_MAX_SIDE) -> Image.Image:
+    check_bytes(len(data))
+    with metrics.timer("image_decode"):
+        try:
+            image = Image.open(BytesIO(data))  # ここではヘッダーだけを読む
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ImageRejected(f"画像として読み込めません（{e}）") from e
+        width, height = image.size
+        if width * height > MAX_PIXELS:
+            raise ImageRejected(f"画素数が多すぎます（{width}x{height}、上限 {MAX_PIXELS / 1_000_000:.0f} MP）")
+        # JPEG のみ有効。要求サイズ以上を保つ範囲で縮小率を選んでからデコードする
+        image.draft("RGB", (max_side, max_side))
+        try:
+            image.thumbnail((max_side, max_side))
+        except OSError as e:
+            raise ImageRejected(f"画像のデコードに失敗しました（{e}）") from e
+        # 縦横が入れ替わる回転でも上限は正方形のため、縮小後に向きを直してよい
+        image = ImageOps.exif_transpose(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+    metrics.incr("image_ingest", scaled="yes" if (width, height) != image.size else "no")
+    return image
+
+
+def load_image_file(path: str, max_side: int = INGEST_MAX_SIDE) -> Image.Image:
+    # 読み込む前にファイルサイズを確認する（上限を超える場合は開かない）
+    check_bytes(os.path.getsize(path))
+    with open(path, "rb") as f:
+        return load_image(f.read(), max_side)
@@ -0,0 +1,178 @@
+# =============================================================================
+# 計測（ステージごとの所要時間・カウンタ・ピーク RSS）
+#   - timer("stage") / observe() でステージの所要時間を記録する（プロセス共通）
+#   - incr() でキャッシュヒットやエラーなどを数える
+#   - 環境変数 METRICS_JSONL_PATH を指定すると、記録ごとに JSON Lines で追記する
+#   - 環境変数 METRICS_PROM_PATH を指定すると、write_prometheus() で
+#     Prometheus のテキスト形式（node_exporter の textfile collector 向け）に書き出す
+# =============================================================================
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+try:
+    import resource  # POSIX のみ
+except ImportError:
+    resource = None
+
+METRICS_JSONL_PATH = os.environ.get("METRICS_JSONL_PATH", "")
+METRICS_PROM_PATH = os.environ.get("METRICS_PROM_PATH", "")
+SAMPLE_WINDOW = 512  # パーセンタイル計算に使う直近のサンプル数
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, str]) -> LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _Timing:
+    __slots__ = ("count", "total", "last", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+
+
+_lock = threading.Lock()
+_timings: Dict[LabelKey, _Timing] = {}
+_counters: Dict[LabelKey, float] = {}
+_jsonl_lock = threading.Lock()
+
+
+def _emit(record: dict) -> None:
+    if not METRICS_JSONL_PATH:
+        return
+    line = json.dumps(record, ensure_ascii=False)
+    with _jsonl_lock, open(METRICS_JSONL_PATH, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+def observe(stage: str, seconds: float, **labels) -> None:
+    key = _key(stage, labels)
+    with _lock:
+        timing = _timings.get(key)
+        if timing is None:
+            timing = _timings[key] = _Timing()
+        timing.count += 1
+        timing.total += seconds
+        timing.last = seconds
+        timing.samples.append(seconds)
+    _emit({"ts": time.time(), "type": "timing", "stage": stage, "seconds": round(seconds, 6), **labels})
+
+
+@contextmanager
+def timer(stage: str, **labels) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def incr(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _emit({"ts": time.time(), "type": "counter", "name": name, "value": value, **labels})
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        # Windows: psutil があればピークのワーキングセット、なければ 0（計測しない）
+        try:
+            import psutil
+        except ImportError:
+            return 0.0
+        return getattr(psutil.Process().memory_info(), "peak_wset", 0) / (1024 * 1024)
+    # Linux の ru_maxrss は KB 単位、macOS はバイト単位
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def percentile(values: List[float], q: float) -> float:
+    # q は 0〜100。ベンチマークなど、並べ替えていない値の列から求めるとき用
+    return _percentile(sorted(values), q)
+
+
+def timing_summary() -> List[dict]:
+    with _lock:
+        items = [(key, t.count, t.total, t.last, sorted(t.samples)) for key, t in _timings.items()]
+    rows = []
+    for (stage, labels), count, total, last, ordered in sorted(items):
+        rows.append({
+            "stage": stage,
+            "labels": dict(labels),
+            "count": count,
+            "last_ms": last * 1000,
+            "mean_ms": total / count * 1000 if count else 0.0,
+            "p50_ms": _percentile(ordered, 50) * 1000,
+            "p95_ms": _percentile(ordered, 95) * 1000,
+        })
+    return rows
+
+
+def counter_summary() -> List[dict]:
+    with _lock:
+        items = sorted(_counters.items())
+    return [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in items]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prom_labels(labels: Tuple[Tuple[str, str], ...], extra: Dict[str, str] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+def prometheus_text() -> str:
+    with _lock:
+        timings = [(key, t.count, t.total, sorted(t.samples)) for key, t in _timings.items()]
+        counters = list(_counters.items())
+    lines = [
+        "# HELP app_stage_seconds Stage latency in seconds (quantiles over recent samples).",
+        "# TYPE app_stage_seconds summary",
+    ]
+    for (stage, labels), count, total, ordered in sorted(timings):
+        labels = (("stage", stage),) + labels
+        for q in (0.5, 0.95):
+            lines.append(f"app_stage_seconds{_prom_labels(labels, {'quantile': str(q)})} {_percentile(ordered, q * 100):.6f}")
+        lines.append(f"app_stage_seconds_sum{_prom_labels(labels)} {total:.6f}")
+        lines.append(f"app_stage_seconds_count{_prom_labels(labels)} {count}")
+    lines += ["# HELP app_events_total Event counters.", "# TYPE app_events_total counter"]
+    for (name, labels), value in sorted(counters):
+        lines.append(f"app_events_total{_prom_labels((('event', name),) + labels)} {value:g}")
+    lines += [
+        "# HELP app_peak_rss_bytes Peak resident set size of the process.",
+        "# TYPE app_peak_rss_bytes gauge",
+        f"app_peak_rss_bytes {int(peak_rss_mb() * 1024 * 1024)}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str = METRICS_PROM_PATH) -> None:
+    if not path:
+        return
+    # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
@@ -0,0 +1,123 @@
+# =============================================================================
+# ペルソナ呼び出しの所要時間とヘッジ（重複リクエスト）の判断
+#   - ペルソナごとに所要時間のヒストグラム（対数間隔のバケット）を持つ
+#     古いサンプルほど重みを減衰させ、上流の混み具合の変化に追従する
+#     種類は応答全体（TOTAL、並列生成のヘッジ）と最初の断片まで（FIRST_TOKEN、ストリーミングのヘッジ）
+#   - ヘッジまでの待ち時間は、そのペルソナの PERSONA_HEDGE_QUANTILE 分位点
+#     （サンプルが少ないうちは全ペルソナ合算、それもなければ既定値）
+#   - ヘッジは本リクエストの PERSONA_HEDGE_BUDGET 割まで（上流の流量制限を食いつぶさない）
+#   - 1ターンの期限 PERSONA_TURN_DEADLINE 秒を過ぎたペルソナは「遅延」として先に進む
+# =============================================================================
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+TURN_DEADLINE = float(os.environ.get("PERSONA_TURN_DEADLINE", "20"))
+HEDGE_QUANTILE = float(os.environ.get("PERSONA_HEDGE_QUANTILE", "0.95"))
+HEDGE_DEFAULT_DELAY = float(os.environ.get("PERSONA_HEDGE_DEFAULT_DELAY", "5"))
+HEDGE_DEFAULT_FIRST_TOKEN_DELAY = float(os.environ.get("PERSONA_HEDGE_DEFAULT_FIRST_TOKEN_DELAY", "2"))
+HEDGE_MIN_DELAY = float(os.environ.get("PERSONA_HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("PERSONA_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_BUDGET = float(os.environ.get("PERSONA_HEDGE_BUDGET", "0.1"))  # 0 でヘッジしない
+HEDGE_BURST = 5.0  # 起動直後や静かな時間のあとに連続して出せるヘッジの数
+TOTAL = "total"
+FIRST_TOKEN = "first_token"
+DECAY = 0.995  # 1サンプルごとの重みの減衰（およそ直近 200 サンプルが効く）
+
+# バケットの上限: 50ms から 1.2 倍ずつ、約 2 分まで
+_BUCKET_BOUNDS: List[float] = [0.05 * 1.2 ** i for i in range(int(math.log(120 / 0.05, 1.2)) + 2)]
+
+
+class LatencyHistogram:
+    """所要時間（秒）の減衰つきヒストグラム。分位点はバケットの上限で答える。"""
+
+    def __init__(self, decay: float = DECAY):
+        self.decay = decay
+        self._weights = [0.0] * len(_BUCKET_BOUNDS)
+        self._total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        if self.decay < 1:
+            self._weights = [w * self.decay for w in self._weights]
+            self._total *= self.decay
+        index = next((i for i, bound in enumerate(_BUCKET_BOUNDS) if seconds <= bound), len(_BUCKET_BOUNDS) - 1)
+        self._weights[index] += 1
+        self._total += 1
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self._total:
+            return None
+        target = q * self._total
+        cumulative = 0.0
+        for bound, weight in zip(_BUCKET_BOUNDS, self._weights):
+            cumulative += weight
+            if cumulative >= target:
+                return bound
+        return _BUCKET_BOUNDS[-1]
+
+
+class HedgePolicy:
+    def __init__(self, quantile: float = HEDGE_QUANTILE, budget: float = HEDGE_BUDGET):
+        self.quantile = quantile
+        self.budget = budget
+        self._histograms: Dict[Tuple[str, str], LatencyHistogram] = {}  # (種類, ペルソナ) -> ヒストグラム
+        self._overall: Dict[str, LatencyHistogram] = {TOTAL: LatencyHistogram(), FIRST_TOKEN: LatencyHistogram()}
+        self._tokens = HEDGE_BURST
+        self._lock = threading.Lock()
+
+    def observe(self, persona: str, seconds: float, kind: str = TOTAL) -> None:
+        # 成功した呼び出しの所要時間（期限後に届いたものも含める。含めないと遅い側を学習できない）
+        with self._lock:
+            histogram = self._histograms.get((kind, persona))
+            if histogram is None:
+                histogram = self._histograms[(kind, persona)] = LatencyHistogram()
+            histogram.observe(seconds)
+            self._overall[kind].observe(seconds)
+
+    def hedge_delay(self, persona: str, kind: str = TOTAL) -> float:
+        with self._lock:
+            histogram = self._histograms.get((kind, persona))
+            if histogram is None or histogram.count < HEDGE_MIN_SAMPLES:
+                histogram = self._overall[kind]
+            delay = histogram.quantile(self.quantile) if histogram.count >= HEDGE_MIN_SAMPLES else None
+        default = HEDGE_DEFAULT_FIRST_TOKEN_DELAY if kind == FIRST_TOKEN else HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, delay if delay is not None else default)
+
+    def record_request(self) -> None:
+        # 本リクエスト1件ごとにヘッジの枠を budget 件分ためる（上限 HEDGE_BURST）
+        with self._lock:
+            self._tokens = min(HEDGE_BURST, self._tokens + self.budget)
+
+    def try_hedge(self) -> bool:
+        with self._lock:
+            if self.budget <= 0 or self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def stats(self, kind: str = TOTAL) -> List[dict]:
+        with self._lock:
+            items = sorted((name, h) for (k, name), h in self._histograms.items() if k == kind)
+            rows = [
+                {"persona": name, "count": h.count, "p50": h.quantile(0.5), "p95": h.quantile(0.95)}
+                for name, h in items
+            ]
+        for row in rows:
+            row["hedge_delay"] = self.hedge_delay(row["persona"], kind)
+        return rows
+
+
+_default_policy: Optional[HedgePolicy] = None
+_default_lock = threading.Lock()
+
+
+def get_policy() -> HedgePolicy:
+    global _default_policy
+    if _default_policy is None:
+        with _default_lock:
+            if _default_policy is None:
+                _default_policy = HedgePolicy()
+    return _default_policy
@@ -0,0 +1,53 @@
+# =============================================================================
+# ペルソナ並列実行エンジン
+#   - プロセスごとに1つのイベントループ（専用スレッド）を共有する
+#   - 同時実行数はセマフォで上限を設ける（全セッション共通）
+#   - HTTP 呼び出しは共有HTTPクライアント（http_client）を使うため、
+#     ブロッキング部分はプロセス共通の有界スレッドプールで実行する
+#     （ターンごとにスレッドプールを作り直さない）
+# =============================================================================
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+MAX_CONCURRENCY = int(os.environ.get("PERSONA_MAX_CONCURRENCY", "16"))
+
+_loop = None
+_semaphore = None
+_io_executor = None
+_init_lock = threading.Lock()
+
+
+def _ensure_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _semaphore, _io_executor
+    if _loop is None:
+        with _init_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                io_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="persona-io")
+                loop.set_default_executor(io_executor)
+                thread = threading.Thread(target=loop.run_forever, name="persona-loop", daemon=True)
+                thread.start()
+                # セマフォはループ上で生成する（Python 3.9 以前はループに紐づくため）
+                _semaphore = asyncio.run_coroutine_threadsafe(_make_semaphore(), loop).result()
+                _io_executor = io_executor
+                _loop = loop
+    return _loop
+
+
+async def _make_semaphore() -> asyncio.Semaphore:
+    return asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+async def _run_bounded(fn: Callable, args: tuple) -> Any:
+    async with _semaphore:
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+def submit(fn: Callable, *args) -> Future:
+    """共有ループ上で fn(*args) を同時実行数の上限内で実行し、concurrent.futures.Future を返す。"""
+    loop = _ensure_loop()
+    return asyncio.run_coroutine_threadsafe(_run_bounded(fn, args), loop)
+
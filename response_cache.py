@@ -0,0 +1,232 @@
+# =============================================================================
+# Gemini 応答キャッシュ ＋ 同一リクエストの集約（single-flight）
+#   - プロンプト（＋モデル名）をキーに、TTL と件数上限つきで応答を保存する
+#   - 同じプロンプトが同時に複数セッションから来た場合、上流への呼び出しは1回だけ行い
+#     結果を全員で共有する
+#   - ストリーミングも同様に集約する（上流からの断片を1本のスレッドで受け、
+#     後から来た同一リクエストは受信済みの断片から順に読む）
+#     ヘッジ用に、集約しない（他の読み手と共有しない）ストリーミングも開始できる
+#     ヘッジが勝ったら以降の読み手はヘッジ側を共有し、負けた側の結果はキャッシュしない（supersede）
+#   - GEMINI_CACHE_TTL=0 でキャッシュを無効化（集約は有効のまま）
+# =============================================================================
+import hashlib
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+from ttl_cache import TTLCache
+
+GEMINI_CACHE_TTL = float(os.environ.get("GEMINI_CACHE_TTL", "600"))
+GEMINI_CACHE_MAX_ENTRIES = int(os.environ.get("GEMINI_CACHE_MAX_ENTRIES", "1024"))
+
+
+class _Call:
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """同じキーの呼び出しが実行中ならその結果を待って共有する。戻り値は (結果, 共有されたか)。"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+        try:
+            call.value = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.value, False
+
+
+class SharedStream:
+    """実行中のストリーミング1本。受信済みの断片を保持し、読み手ごとに先頭から順に返す。"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.cancelled = False
+        self.superseded = False  # ヘッジに負けた（読み手には返すが、キャッシュには入れない）
+        self.cond = threading.Condition()
+        self._listeners: List[threading.Event] = []
+
+    def ready(self) -> bool:
+        # 最初の断片が届いたか、終了した
+        return bool(self.chunks) or self.done
+
+    def succeeded_or_streaming(self) -> bool:
+        return bool(self.chunks) or (self.done and self.error is None)
+
+    def notify_ready(self, event: threading.Event) -> None:
+        # 最初の断片の到着または終了時に event をセットする（複数のストリームを待ち合わせる用）
+        with self.cond:
+            self._listeners.append(event)
+            if self.ready():
+                event.set()
+
+    def cancel(self) -> None:
+        # 読み手がいなくなった（共有しない）ストリームの受信をやめる
+        self.cancelled = True
+
+    def append(self, chunk: str) -> None:
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+            for event in self._listeners:
+                event.set()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+            for event in self._listeners:
+                event.set()
+
+    def read(self) -> Iterator[str]:
+        position = 0
+        while True:
+            with self.cond:
+                while position >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                new_chunks = self.chunks[position:]
+                position = len(self.chunks)
+                finished, error = self.done, self.error
+            yield from new_chunks
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = GEMINI_CACHE_TTL, max_entries: int = GEMINI_CACHE_MAX_ENTRIES):
+        self.enabled = ttl > 0
+        self._memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self._flight = SingleFlight()
+        self._streams: Dict[str, SharedStream] = {}
+        self._streams_lock = threading.Lock()
+        self.shared_streams = 0
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        return self._memory.get(key) if self.enabled else None
+
+    def put(self, key: str, value: Any) -> None:
+        if self.enabled:
+            self._memory.set(key, value)
+
+    def get_or_call(self, key: str, fn: Callable[[], Tuple[Any, bool]]) -> Tuple[Any, str]:
+        """
+        fn() -> (値, キャッシュしてよいか)。戻り値は (値, 取得元) で、取得元は
+        "hit"（キャッシュ） / "shared"（実行中の同一リクエストを共有） / "miss"（上流を呼んだ）。
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached, "hit"
+
+        def leader():
+            value, cacheable = fn()
+            if cacheable:
+                self.put(key, value)
+            return value
+
+        value, shared = self._flight.do(key, leader)
+        return value, "shared" if shared else "miss"
+
+    def stream(self, key: str, open_stream: Callable[[], Iterable[str]],
+               finish: Callable[[str], Optional[Any]], coalesce: bool = True) -> Tuple[SharedStream, str]:
+        """
+        ストリーミング版の集約。同じキーのストリーミングが実行中ならその断片を共有する。
+        上流からの受信は専用スレッドで行うため、読み手が途中でやめても他の読み手は止まらない。
+        全文を受け取ったら finish(全文) -> キャッシュする値（None ならキャッシュしない）。
+        coalesce=False なら実行中のものがあっても新たに開始し、共有もしない（ヘッジ用。勝てば supersede で共有される）。
+        戻り値は (ストリーム（read() で断片を読む）, 取得元 "shared" / "miss")。キャッシュは呼び出し側で先に引く。
+        """
+        flight = SharedStream()
+        if coalesce:
+            with self._streams_lock:
+                running = self._streams.get(key)
+                if running is not None:
+                    self.shared_streams += 1
+                    return running, "shared"
+                self._streams[key] = flight
+
+        def pump():
+            text = ""
+            error = None
+            try:
+                for chunk in open_stream():
+                    if flight.cancelled:
+                        break  # ジェネレーターを閉じると上流との接続も閉じる
+                    text += chunk
+                    flight.append(chunk)
+                else:
+                    value = finish(text)
+                    if value is not None and not (flight.cancelled or flight.superseded):
+                        self.put(key, value)
+            except BaseException as e:
+                error = e
+            finally:
+                # 登録の解除と終了を同時に行う（supersede が終了済みのストリームを登録しないように）
+                with self._streams_lock:
+                    if self._streams.get(key) is flight:
+                        del self._streams[key]
+                    flight.finish(error)
+
+        threading.Thread(target=pump, name="gemini-stream", daemon=True).start()
+        return flight, "miss"
+
+    def supersede(self, key: str, loser: SharedStream, winner: SharedStream) -> None:
+        """ヘッジで winner が先に応答したとき、同じキーの新しい読み手を winner に向け、loser はキャッシュしない。"""
+        with self._streams_lock:
+            loser.superseded = True
+            if self._streams.get(key) is loser:
+                if winner.done:
+                    del self._streams[key]
+                else:
+                    self._streams[key] = winner
+
+    def stats(self) -> dict:
+        result = self._memory.stats()
+        result["shared"] = self._flight.shared + self.shared_streams
+        return result
+
+
+_default_cache: Optional[ResponseCache] = None
+_default_lock = threading.Lock()
+
+
+def get_cache() -> ResponseCache:
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = ResponseCache()
+    return _default_cache
@@ -0,0 +1,128 @@
+# =============================================================================
+# Tavily 検索結果のキャッシュ
+#   - TTL と件数上限つき（LRU）。「最新情報」が古くなり続けないよう期限を設ける
+#   - クエリを正規化してキーにする（全角／半角の統一、大文字小文字、空白）
+#   - 失敗したクエリも短い TTL で保存する（ネガティブキャッシュ）
+#   - 環境変数 SEARCH_CACHE_PATH を指定すると SQLite に保存し、再起動後も引き継ぐ
+#     （書き込み EVICT_EVERY 回ごとに期限切れと件数上限を超えた分を削除する）
+# =============================================================================
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Callable, NamedTuple, Optional, Tuple
+
+from ttl_cache import TTLCache
+
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "900"))
+SEARCH_CACHE_NEGATIVE_TTL = float(os.environ.get("SEARCH_CACHE_NEGATIVE_TTL", "60"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "512"))
+SEARCH_CACHE_PATH = os.environ.get("SEARCH_CACHE_PATH", "")
+# 書き込み何回ごとに SQLite の削除処理を走らせるか
+EVICT_EVERY = 50
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    # NFKC で全角英数・半角カナなどを統一し、大文字小文字と空白の違いを吸収する
+    query = unicodedata.normalize("NFKC", query or "")
+    return _WHITESPACE.sub(" ", query).strip().casefold()
+
+
+class SearchResult(NamedTuple):
+    answer: str
+    cache: str   # "hit" / "negative-hit" / "miss"
+    detail: str  # 取得時のステータス（miss のときのみ）
+
+
+class SearchCache:
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, negative_ttl: float = SEARCH_CACHE_NEGATIVE_TTL,
+                 max_entries: int = SEARCH_CACHE_MAX_ENTRIES, path: Optional[str] = SEARCH_CACHE_PATH or None):
+        self.negative_ttl = negative_ttl
+        self.path = path
+        self.max_entries = max_entries
+        self._writes = 0
+        # 値は (成功したか, 回答)
+        self._memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self._db_lock = threading.Lock()
+        if path:
+            try:
+                self._load()
+            except (sqlite3.Error, OSError):
+                # 保存先を作れない・書き込めない・壊れている場合はメモリ上のキャッシュだけで動く
+                self.path = None
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS search ("
+            " key TEXT PRIMARY KEY, answer TEXT NOT NULL, ok INTEGER NOT NULL, expires_at REAL NOT NULL)"
+        )
+        return conn
+
+    def _load(self) -> None:
+        self.evict()
+        with self._db_lock, self._connect() as conn:
+            rows = conn.execute("SELECT key, answer, ok, expires_at FROM search ORDER BY expires_at").fetchall()
+        for key, answer, ok, expires_at in rows:
+            self._memory.set(key, (bool(ok), answer), expires_at=expires_at)
+
+    def _persist(self, key: str, answer: str, ok: bool, expires_at: float) -> None:
+        try:
+            with self._db_lock, self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO search VALUES (?, ?, ?, ?)", (key, answer, int(ok), expires_at))
+                self._writes += 1
+                run_evict = self._writes % EVICT_EVERY == 0
+            if run_evict:
+                self.evict()
+        except (sqlite3.Error, OSError):
+            pass  # 永続化はベストエフォート（メモリ上のキャッシュは有効）
+
+    def evict(self) -> int:
+        # 期限切れを削除し、件数上限を超えた分を期限の近い（古い）順に削除する
+        with self._db_lock, self._connect() as conn:
+            removed = conn.execute("DELETE FROM search WHERE expires_at <= ?", (time.time(),)).rowcount
+            (count,) = conn.execute("SELECT COUNT(*) FROM search").fetchone()
+            if count > self.max_entries:
+                removed += conn.execute(
+                    "DELETE FROM search WHERE key IN ("
+                    " SELECT key FROM search ORDER BY expires_at ASC LIMIT ?)", (count - self.max_entries,)
+                ).rowcount
+        return removed
+
+    def lookup(self, query: str, fetch: Callable[[str], Tuple[str, bool, str]]) -> SearchResult:
+        """
+        キャッシュを引き、なければ fetch(query) -> (回答, 成功したか, ステータス) を呼んで保存する。
+        """
+        key = normalize_query(query)
+        cached = self._memory.get(key)
+        if cached is not None:
+            ok, answer = cached
+            return SearchResult(answer, "hit" if ok else "negative-hit", "")
+        answer, ok, detail = fetch(query)
+        ttl = self._memory.ttl if ok else self.negative_ttl
+        expires_at = time.time() + ttl
+        self._memory.set(key, (ok, answer), expires_at=expires_at)
+        if self.path:
+            self._persist(key, answer, ok, expires_at)
+        return SearchResult(answer, "miss", detail)
+
+    def stats(self) -> dict:
+        return self._memory.stats()
+
+
+_default_cache: Optional[SearchCache] = None
+_default_lock = threading.Lock()
+
+
+def get_cache() -> SearchCache:
+    global _default_cache
+    if _default_cache is None:
+        with _default_lock:
+            if _default_cache is None:
+                _default_cache = SearchCache()
+    return _default_cache
@@ -0,0 +1,102 @@
+# =============================================================================
+# 検索要否の判定（オフライン・ルールベース）
+#   ユーザーの発言が最新のウェブ情報を必要とするかをローカルで判定する。
+#   雑談・あいさつ・短い相づちは検索しない。時事・数値・日時に関わる質問は検索する。
+#   日時や時事の語だけでは検索しない（「今日は疲れた」）。質問・依頼の形のときだけ検索する。
+#   事実を問う質問の判定は雑談より先に行う（あいさつに似た語で始まる質問を取りこぼさない）。
+#   `python search_gate.py` で REGRESSION_CASES の判定を確認できる。
+# =============================================================================
+import re
+import unicodedata
+from typing import List, NamedTuple, Tuple
+
+# 最新性が必要な話題（質問・依頼の形と組み合わさったときに検索する）
+_FRESHNESS = re.compile(
+    r"最新|最近|現在|今日|昨日|明日|今週|先週|来週|今月|先月|来月|今年|去年|昨年|来年|今の|"
+    r"ニュース|速報|天気|気温|台風|地震|株価|為替|レート|相場|価格|値段|料金|"
+    r"結果|試合|優勝|選挙|発表|発売|リリース|公開|開催|営業時間|ランキング|"
+    # 年号は「年」か日付の形のときだけ（「2000円」などの金額は除く）
+    r"(?:19|20)\d{2}(?:年|[/-]\d{1,2}(?!\d))|"
+    # 英単語は前後が英字でないときだけ（日本語は \w に含まれるため \b では区切れない）
+    r"(?<![a-z])(?:latest|news|today|yesterday|tomorrow|weather|price|score|release)(?![a-z])"
+)
+# 事実を問う質問（疑問文と組み合わさったときに検索する）
+_FACTUAL = re.compile(
+    r"とは|って何|ってなに|誰|だれ|どこ|いつ|いくら|"
+    r"何(?:人|個|年|月|日|時|曜|歳|位|回|円|度|メートル|キロ)|"
+    r"は(?:何|なに)(?:です|でしょう|[?？]|$)|どれくらい|どのくらい|"
+    r"高さ|長さ|広さ|重さ|深さ|面積|距離|標高|人口|首都|首相|大統領|作者|著者|原因|定義|歴史|意味|由来|場所|住所|"
+    r"(?<![a-z])(?:what|who|where|when|how many|how much)(?![a-z])"
+)
+# 質問・依頼の形（「かな」は独り言にも使うため、最新性の判定には使わない）
+_REQUEST = re.compile(r"[?？]|ですか|ますか|でしょう|教えて|調べて|知りたい")
+_QUESTION = re.compile(_REQUEST.pattern + r"|かな")
+# 雑談・あいさつ・相づち（発言全体がこれらと記号だけの場合）
+_SMALL_TALK = re.compile(
+    r"^(?:(?:こんにちは|こんばんは|おはよう(?:ございます)?|おやすみ(?:なさい)?|ありがとう(?:ございます)?|"
+    r"よろしく(?:お願いします|ね)?|はじめまして|元気(?:です)?か?|すごい(?:ね)?|なるほど(?:ね)?|"
+    r"そうだね|そうなんだ(?:ね)?|いいね|うん|はい|いいえ|えー|へー|ふーん|笑|草|w+|"
+    r"(?<![a-z])(?:hi|hello|hey|thanks|thank you|ok|okay|lol)(?![a-z]))[、,\s]*)+"
+    r"[!！?？。.~〜w笑ー\s]*$"
+)
+MIN_LENGTH = 5
+
+
+class GateDecision(NamedTuple):
+    search: bool
+    reason: str
+
+
+def needs_web_search(text: str) -> GateDecision:
+    normalized = unicodedata.normalize("NFKC", text or "").strip().casefold()
+    if _FRESHNESS.search(normalized) and _REQUEST.search(normalized):
+        return GateDecision(True, "最新情報が必要な質問")
+    if len(normalized) < MIN_LENGTH:
+        return GateDecision(False, "短い発言")
+    if _FACTUAL.search(normalized) and _QUESTION.search(normalized):
+        return GateDecision(True, "事実を問う質問")
+    if _SMALL_TALK.match(normalized):
+        return GateDecision(False, "雑談・あいさつ")
+    return GateDecision(False, "一般的な会話")
+
+
+# 判定の回帰確認用（発言, 検索するか）。あいさつに似た語で始まる質問を雑談と誤判定しないこと
+REGRESSION_CASES: List[Tuple[str, bool]] = [
+    ("what is the capital of France?", True),
+    ("Where is Tokyo Tower?", True),
+    ("who invented the telephone?", True),
+    ("hiroshimaの人口はどのくらい？", True),
+    ("okinawaの人口は？", True),
+    ("草津温泉の場所はどこですか？", True),
+    ("元気が出る食べ物は何ですか？", True),
+    ("はいからさんって誰ですか？", True),
+    ("こんにちは！", False),
+    ("ありがとうございます！", False),
+    ("こんにちは、元気？", False),
+    ("なるほどね〜", False),
+    ("wwwwww", False),
+    ("thank you!!", False),
+    ("最近おすすめの本を教えて", True),
+    ("週末は何をして過ごすのが好き？", False),
+    # 日時・時事の語を含むだけの雑談は検索しない
+    ("今日は疲れたなあ", False),
+    ("今日も一日お疲れさま！", False),
+    ("昨日の夜ご飯おいしかった", False),
+    ("試合に負けて悔しい", False),
+    ("2000円のランチ食べた", False),
+    ("今日の天気は？", True),
+    ("2024年の優勝チームはどこ？", True),
+    ("最新のiphoneの価格を教えて", True),
+    # 手がかりの語がない事実の質問
+    ("富士山の高さは？", True),
+    ("東京タワーの高さを教えて", True),
+    ("日本の首都はどこですか", True),
+]
+
+
+if __name__ == "__main__":
+    failures = [(text, expected) for text, expected in REGRESSION_CASES if needs_web_search(text).search != expected]
+    for text, expected in failures:
+        print(f"NG: {text!r} -> {needs_web_search(text)}（期待: search={expected}）")
+    print(f"{len(REGRESSION_CASES) - len(failures)}/{len(REGRESSION_CASES)} 件一致")
+    raise SystemExit(1 if failures else 0)
@@ -0,0 +1,210 @@
+# =============================================================================
+# 上流 API（Gemini / Tavily）のプロセス共通スケジューラ
+#   - トークンバケットによる流量制限（RPM: 1分あたりのリクエスト数、TPM: 1分あたりのトークン数）
+#   - 優先度つきの待ち行列（対話のターンを画像コメントより先に通す）
+#   - サーキットブレーカー（連続して失敗したら一定時間すぐに失敗を返し、上流を休ませる）
+# =============================================================================
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+PRIORITY_INTERACTIVE = 0  # ユーザーの発言に対する応答
+PRIORITY_BACKGROUND = 1   # 画像アップロード時のコメントなど
+
+DEFAULT_ACQUIRE_TIMEOUT = float(os.environ.get("UPSTREAM_ACQUIRE_TIMEOUT", "30"))
+
+
+class UpstreamUnavailable(Exception):
+    """サーキットブレーカーが開いている、または流量制限の待ち時間を超えた。"""
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        # per_minute <= 0 なら無制限
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def refill(self, now: float) -> None:
+        if not self.unlimited:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # amount を取り出せるまでの秒数（容量を超える要求は容量いっぱいまで待てば通す）
+        if self.unlimited:
+            return 0.0
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float) -> None:
+        if not self.unlimited:
+            self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    def __init__(self, rpm: float, tpm: float = 0):
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._cond = threading.Condition()
+        self._waiters = []  # (優先度, 到着順) のヒープ。先頭だけがトークンを取れる
+        self._seq = itertools.count()
+
+    def acquire(self, cost: int = 0, priority: int = PRIORITY_INTERACTIVE, timeout: float = DEFAULT_ACQUIRE_TIMEOUT) -> bool:
+        entry = (priority, next(self._seq))
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._requests.refill(now)
+                    self._tokens.refill(now)
+                    wait = max(self._requests.wait_time(1), self._tokens.wait_time(cost))
+                    if self._waiters[0] == entry and wait <= 0:
+                        self._requests.take(1)
+                        self._tokens.take(cost)
+                        return True
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return False
+                    # 先頭でなければ前の待ち手が通るまで待つ
+                    self._cond.wait(min(wait, remaining) if self._waiters[0] == entry else remaining)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._waiters)
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                # 半開状態では1件だけ試しに通す
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        # 半開状態の試行枠を、結果を記録せずに返す
+        with self._lock:
+            self._probe_in_flight = False
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+
+class Upstream:
+    def __init__(self, name: str, rpm: float, tpm: float = 0, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.limiter = RateLimiter(rpm, tpm)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    def available(self) -> bool:
+        # 呼び出し前の判定用（開いていれば検索を省くなどの縮退に使う）
+        return self.breaker.state != CircuitBreaker.OPEN or self.breaker.retry_after() <= 0
+
+    def call(self, fn: Callable, *args, priority: int = PRIORITY_INTERACTIVE, cost: int = 0,
+             is_failure: Callable = lambda result: False, timeout: float = DEFAULT_ACQUIRE_TIMEOUT):
+        """
+        流量制限とサーキットブレーカーを通して fn(*args) を呼ぶ。
+        is_failure(結果) が True、または例外の場合はブレーカーに失敗として記録する。
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(f"{self.name}: 一時停止中（あと {self.breaker.retry_after():.0f} 秒）")
+        if not self.limiter.acquire(cost, priority, timeout):
+            # 流量待ちのタイムアウトは上流の不調ではないため、ブレーカーには記録しない
+            self.breaker.release_probe()
+            raise UpstreamUnavailable(f"{self.name}: 混雑のため待ち時間を超えました")
+        try:
+            result = fn(*args)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        if is_failure(result):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return result
+
+    def status(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "retry_after": self.breaker.retry_after(),
+            "queued": self.limiter.queued(),
+        }
+
+
+_UPSTREAM_CONFIG: Dict[str, Tuple[float, float]] = {
+    "gemini": (float(os.environ.get("GEMINI_RPM", "120")), float(os.environ.get("GEMINI_TPM", "1000000"))),
+    "tavily": (float(os.environ.get("TAVILY_RPM", "60")), 0),
+}
+BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("UPSTREAM_BREAKER_RESET", "30"))
+
+_upstreams: Dict[str, Upstream] = {}
+_lock = threading.Lock()
+
+
+def get_upstream(name: str) -> Upstream:
+    if name not in _upstreams:
+        with _lock:
+            if name not in _upstreams:
+                rpm, tpm = _UPSTREAM_CONFIG.get(name, (0, 0))
+                _upstreams[name] = Upstream(name, rpm, tpm, BREAKER_FAILURES, BREAKER_RESET_SECONDS)
+    return _upstreams[name]
+
+
+def retryable_status(status_code: Optional[int]) -> bool:
+    # ブレーカーが失敗とみなす HTTP ステータス（429 と 5xx）
+    return status_code is not None and (status_code == 429 or status_code >= 500)
@@ -0,0 +1,99 @@
+# =============================================================================
+# ViT 推論ワーカー（セッションをまたいだマイクロバッチ）
+#   - モデルを持つ専用スレッドが1本だけ推論する（セッションのスレッド同士で CPU を奪い合わない）
+#   - 最初の依頼から最大 VIT_BATCH_WAIT_MS ミリ秒、または VIT_BATCH_MAX 枚まで依頼を集め、
+#     全画像の全ビューを1回の順伝播で推論する
+#   - 依頼ごとの Future に解析結果（上位ラベルの文字列）を返す
+#   VIT_BATCH_MAX=1 にするとバッチ化しない（推論は引き続きワーカースレッドで行う）。
+# =============================================================================
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterable, List
+
+import image_analysis
+import metrics
+
+BATCH_MAX = int(os.environ.get("VIT_BATCH_MAX", "8"))
+BATCH_WAIT_MS = float(os.environ.get("VIT_BATCH_WAIT_MS", "10"))
+
+
+class _Request:
+    __slots__ = ("image", "augmentations", "future", "enqueued")
+
+    def __init__(self, image, augmentations, future: Future):
+        self.image = image
+        self.augmentations = tuple(augmentations)
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class InferenceWorker:
+    def __init__(self, tier: str = image_analysis.MODEL_TIER, max_batch: int = BATCH_MAX, max_wait_ms: float = BATCH_WAIT_MS):
+        self.tier = tier
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, image, augmentations: Iterable[str] = image_analysis.TTA_CONFIG) -> Future:
+        # image は取り込み済み（image_ingest で縮小済み）の PIL 画像
+        future = Future()
+        self._ensure_started()
+        self._queue.put(_Request(image, augmentations, future))
+        return future
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"vit-worker-{self.tier}", daemon=True)
+                    self._thread.start()
+
+    def _collect(self) -> List[_Request]:
+        # 最初の1件が来るまで待ち、そこから締め切りまでに届いた依頼をまとめる
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = [request for request in self._collect() if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for request in batch:
+                metrics.observe("vit_queue_wait", started - request.enqueued)
+            metrics.incr("vit_batch", size=len(batch))
+            try:
+                # モデルは初回のバッチでこのスレッドが読み込む（以降はプロセス内のキャッシュ）
+                extractor, model = image_analysis.get_model(self.tier)
+                logits = image_analysis.predict_logits_batch(
+                    [(request.image, request.augmentations) for request in batch], extractor, model
+                )
+                for request, avg_logits in zip(batch, logits):
+                    request.future.set_result(image_analysis.format_topk(avg_logits, model.config.id2label))
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+
+
+_workers: Dict[str, InferenceWorker] = {}
+_lock = threading.Lock()
+
+
+def get_worker(tier: str = image_analysis.MODEL_TIER) -> InferenceWorker:
+    if tier not in _workers:
+        with _lock:
+            if tier not in _workers:
+                _workers[tier] = InferenceWorker(tier)
+    return _workers[tier]